@@ -1,99 +1,205 @@
-from flask import Flask, request
+import os
+import hmac
 import asyncio
-import nest_asyncio
+import logging
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-import os
-import json
-import requests  # <-- добавляем для установки вебхука
-
-nest_asyncio.apply()
-
-app = Flask(__name__)
 
-from config import TELEGRAM_TOKEN
+from config import (
+    TELEGRAM_TOKEN, WEBHOOK_BASE_URL, WEBHOOK_SECRET, UPDATE_WORKERS, UPDATE_POLL_INTERVAL, UPDATE_QUEUE_LEASE_SECONDS,
+    UPDATE_MAX_CLAIMED,
+)
 import database as db
+import downloader
+import ytdlp_worker
 import referral_system as ref
-from bot import (
-    start, button_handler, handle_message, callback_handler, 
-    admin_command, show_admin_panel
-)
+import updates
+import scheduler
+import disk_cache
+from bot import build_application
 
-# Создаём приложение бота
-application = Application.builder().token(TELEGRAM_TOKEN).build()
-
-# Асинхронный цикл
-loop = asyncio.get_event_loop()
-
-# Инициализация базы и бота
-loop.run_until_complete(db.init_db())
-loop.run_until_complete(ref.init_referral_tables())
-loop.run_until_complete(application.initialize())
-
-# Регистрируем хэндлеры
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("admin", admin_command))
-application.add_handler(
-    MessageHandler(
-        filters.Regex(
-            '^(📌 Pinterest|🎵 TikTok|📦 Массовая загрузка|💎 Plus\+|👤 My Account|🔧 Admin Panel)$'
-        ),
-        button_handler
-    )
-)
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-application.add_handler(CallbackQueryHandler(callback_handler))
+logger = logging.getLogger(__name__)
 
-# Главная страница
-@app.route('/')
-def index():
-    return 'MaxSaver Bot is running!', 200
+# Приложение бота живёт в том же event loop, что и ASGI-сервер.
+# Вебхук только сохраняет апдейт в очередь в Postgres и сразу отвечает Telegram,
+# обработкой занимается update_worker — апдейты переживают рестарт и делятся между инстансами
+application = build_application()
 
-# Вебхук для Telegram
-@app.route(f'/{TELEGRAM_TOKEN}', methods=['POST'])
-def webhook():
+WEBHOOK_PATH = f"/{TELEGRAM_TOKEN}"
+
+_update_wakeup = asyncio.Event()
+# queue_id -> lease_token апдейтов, которые сейчас обрабатывает этот инстанс
+_leases = {}
+
+async def process_queued_update(row: dict):
+    _leases[row['id']] = row['lease_token']
+    update_id = row['payload'].get('update_id')
+    updates.set_lease(update_id, row['id'], row['lease_token'], row['attempts'])
     try:
-        json_data = request.get_json(force=True)
-        update = Update.de_json(json_data, application.bot)
-        asyncio.run(application.process_update(update))
-        return 'OK', 200
+        update = Update.de_json(row['payload'], application.bot)
+        await application.update_processor.process_update(update, application.process_update(update))
     except Exception as e:
-        print(f"Error processing update: {e}")
-        return 'Error', 500
+        # апдейт остаётся в очереди и будет взят повторно после окончания аренды
+        logger.error(f"Ошибка обработки апдейта {update_id}: {e}", exc_info=True)
+        return
+    finally:
+        _leases.pop(row['id'], None)
+        updates.clear_lease(update_id)
+    await db.complete_update(row['id'], row['lease_token'])
 
-# Проверка "живости"
-@app.route('/ping')
-def ping():
-    return {'status': 'ok', 'message': 'Bot is alive'}, 200
+# Пока апдейт обрабатывается, его аренда продлевается — долгое скачивание не отдаёт апдейт другому воркеру
+async def lease_heartbeat():
+    while True:
+        await asyncio.sleep(UPDATE_QUEUE_LEASE_SECONDS / 3)
+        if not _leases:
+            continue
+        leases = dict(_leases)
+        try:
+            held = await db.extend_update_leases(leases)
+        except Exception as e:
+            logger.warning(f"Не удалось продлить аренду апдейтов: {e}")
+            continue
+        for queue_id in leases.keys() - held:
+            if queue_id in _leases:
+                logger.error(f"Аренда апдейта {queue_id} потеряна — его мог взять другой воркер")
 
-# Информация о вебхуке
-@app.route('/webhook_info')
-def webhook_info():
-    response = requests.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getWebhookInfo")
-    return response.json(), 200
+# Апдейты, ждущие предыдущий апдейт того же пользователя, не занимают слоты UPDATE_WORKERS —
+# иначе один пользователь с пачкой сообщений остановил бы обработку всех остальных.
+# Общее число взятых из очереди апдейтов ограничено UPDATE_MAX_CLAIMED.
+async def update_worker():
+    in_flight = set()
+    while True:
+        try:
+            active = len(in_flight) - application.update_processor.waiting_updates
+            free = min(UPDATE_WORKERS - active, UPDATE_MAX_CLAIMED - len(in_flight))
+            if free <= 0:
+                # таймаут — на случай, если взятые апдейты встали в очередь за своим пользователем
+                await asyncio.wait(in_flight, timeout=UPDATE_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            
+            rows = await db.claim_updates(free)
+            if not rows:
+                _update_wakeup.clear()
+                try:
+                    await asyncio.wait_for(_update_wakeup.wait(), timeout=UPDATE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            # задачи создаются в порядке поступления апдейтов
+            for row in rows:
+                task = asyncio.create_task(process_queued_update(row))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            # даём задачам дойти до блокировки пользователя, чтобы ждущие не считались занятыми слотами
+            await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди апдейтов: {e}")
+            await asyncio.sleep(UPDATE_POLL_INTERVAL)
 
 # ======== Автоматическая установка вебхука ========
-def set_webhook():
+async def set_webhook():
     try:
-        WEBHOOK_URL = f"https://max-7ftv.onrender.com/{TELEGRAM_TOKEN}"
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook",
-            json={
-                "url": WEBHOOK_URL,
-                "allowed_updates": ["message", "callback_query"]
-            }
+        webhook_url = f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}"
+        await application.bot.set_webhook(
+            url=webhook_url,
+            allowed_updates=["message", "callback_query"],
+            secret_token=WEBHOOK_SECRET or None
         )
-        result = response.json()
-        if result.get("ok"):
-            print(f"✅ Webhook установлен автоматически: {WEBHOOK_URL}")
-        else:
-            print(f"❌ Ошибка установки вебхука: {result}")
+        print(f"✅ Webhook установлен автоматически: {webhook_url}")
     except Exception as e:
         print(f"⚠️ Ошибка при попытке установить вебхук: {e}")
 
+# Инициализация базы и бота при старте, закрытие пулов при остановке
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    await db.init_db()
+    await ref.init_referral_tables()
+    await downloader.init_http_client()
+    ytdlp_worker.start_pool()
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задан — запросы к вебхуку не проверяются")
+    try:
+        async with application:
+            await application.start()
+            worker = asyncio.create_task(update_worker())
+            heartbeat = asyncio.create_task(lease_heartbeat())
+            try:
+                await set_webhook()
+                yield
+            finally:
+                worker.cancel()
+                heartbeat.cancel()
+                await asyncio.gather(worker, heartbeat, return_exceptions=True)
+                if application.running:
+                    await application.stop()
+    finally:
+        await disk_cache.flush_index()
+        await downloader.close_http_client()
+        await db.close_db()
+        ytdlp_worker.shutdown_pool()
+
+# Главная страница
+async def index(request: Request):
+    return PlainTextResponse('MaxSaver Bot is running!')
+
+# Вебхук для Telegram
+async def webhook(request: Request):
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET
+    ):
+        return Response(status_code=403)
+    try:
+        payload = await request.json()
+    except Exception as e:
+        logger.error(f"Некорректный апдейт: {e}")
+        return Response(status_code=400)
+    await db.enqueue_update(payload)
+    _update_wakeup.set()
+    return Response(status_code=200)
+
+# Проверка "живости"
+async def ping(request: Request):
+    return JSONResponse({'status': 'ok', 'message': 'Bot is alive'})
+
+# Метрики: обработка апдейтов, очередь скачиваний, кэши
+async def stats(request: Request):
+    return JSONResponse({
+        'updates': application.update_processor.stats(),
+        'dedup': updates.get_stats(),
+        'persistence': application.persistence.stats(),
+        'downloads': scheduler.get_stats(),
+        'inflight': downloader.get_inflight_stats(),
+        'disk_cache': disk_cache.get_stats(),
+        'metadata_cache': downloader.get_metadata_cache_stats(),
+        'http': downloader.get_http_stats(),
+        'ytdlp': ytdlp_worker.get_stats(),
+    })
+
+# Информация о вебхуке
+async def webhook_info(request: Request):
+    info = await application.bot.get_webhook_info()
+    return JSONResponse(info.to_dict())
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route(WEBHOOK_PATH, webhook, methods=['POST']),
+        Route('/ping', ping),
+        Route('/stats', stats),
+        Route('/webhook_info', webhook_info),
+    ],
+    lifespan=lifespan,
+)
+
 if __name__ == '__main__':
-    # Ставим вебхук при старте
-    set_webhook()
+    import uvicorn
 
     port = int(os.getenv('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    uvicorn.run(app, host='0.0.0.0', port=port)
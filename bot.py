@@ -1,20 +1,23 @@
 import asyncio
-import nest_asyncio
 import os
+import signal
 import uuid
 import re
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo, InputMediaAudio
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 from telegram.constants import ParseMode
 import database as db
 import downloader
+import disk_cache
+import scheduler
+import ytdlp_worker
+import updates
+from persistence import PostgresPersistence
 import payments
 import referral_system as ref
-from config import TELEGRAM_TOKEN, PACKAGES, FREE_DOWNLOAD_LIMIT, ADMIN_IDS, BOT_USERNAME
+from config import TELEGRAM_TOKEN, PACKAGES, FREE_DOWNLOAD_LIMIT, ADMIN_IDS, BOT_USERNAME, MASS_DOWNLOAD_CONCURRENCY, MASS_PROGRESS_INTERVAL, CONCURRENT_UPDATES
 import logging
 
-nest_asyncio.apply()
-
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -23,6 +26,11 @@ def escape_markdown(text: str) -> str:
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
+def format_wait_time(delta) -> str:
+    minutes = max(int(delta.total_seconds() // 60), 1) if delta else 1
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes} мин" if hours else f"{minutes} мин"
+
 async def delete_message_later(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay: int = 20):
     await asyncio.sleep(delay)
     try:
@@ -242,7 +250,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = update.message.text
     
-    if await db.is_user_blocked(user.id):
+    gate = await db.get_user_gate(user.id)
+    
+    if gate['is_blocked']:
         await update.message.reply_text(
             "🚫 *Доступ заблокирован*",
             parse_mode=ParseMode.MARKDOWN
@@ -597,7 +607,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         asyncio.create_task(delete_message_later(context, update.effective_chat.id, msg.message_id, 20))
         return
     
-    has_mass = await db.has_feature(user.id, 'mass_download')
+    has_mass = 'mass_download' in gate['features']
     
     if len(urls) > 1 and not has_mass:
         msg = await update.message.reply_text(
@@ -642,82 +652,219 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         for url in urls:
-            await process_video_url(update, context, url)
+            await process_video_url(update, context, url, gate)
 
-async def process_mass_download_video(query, context: ContextTypes.DEFAULT_TYPE, url: str, quality: str):
-    user = query.from_user
-    
+# Массовая загрузка идёт конвейером: подготовка (метаданные и скачивание) выполняется
+# параллельно для MASS_DOWNLOAD_CONCURRENCY ссылок, а отправка — строго в исходном порядке
+async def prepare_mass_item(user_id: int, url: str, quality: str, semaphore: asyncio.Semaphore):
     if not downloader.is_valid_url(url):
-        return
+        return None
+    
+    audio_only = quality == 'audio'
+    video_quality = quality if quality != 'audio' else None
+    item = {
+        'url': url,
+        'quality': video_quality,
+        'audio_only': audio_only,
+        'platform': 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok',
+        'cache_key': downloader.delivery_key(url, video_quality, audio_only),
+        'filename': None,
+        'cached': None,
+    }
+    
+    async with semaphore:
+        try:
+            item['cached'] = await db.get_cached_file(item['cache_key'])
+            if item['cached']:
+                return item
+            
+            info = await downloader.extract_video_info_async(url)
+            if not info:
+                return None
+            
+            item['filename'] = await run_download(user_id, url, video_quality, audio_only)
+            return item if item['filename'] else None
+        except Exception as e:
+            logger.error(f"Ошибка загрузки: {e}")
+            return None
+
+async def deliver_mass_item(query, item, reservation=None) -> bool:
+    user = query.from_user
     
-    info = await downloader.extract_video_info_async(url)
-    if not info:
-        return
+    if not item['filename']:
+        if await send_cached_file(query.message, item['cache_key'], mass=True, cached=item['cached']):
+            await commit_download(user.id, item['platform'], reservation)
+            await ref.process_download_coins(user.id)
+            return True
+        # file_id устарел — скачиваем как обычно
+        try:
+            item['filename'] = await run_download(user.id, item['url'], item['quality'], item['audio_only'])
+        except Exception as e:
+            logger.error(f"Ошибка загрузки: {e}")
+            return False
+        if not item['filename']:
+            return False
     
+    filename = item['filename']
     try:
-        audio_only = quality == 'audio'
-        filename = await downloader.download_video(url, quality if quality != 'audio' else None, audio_only)
+        if not os.path.exists(filename):
+            return False
         
-        if filename and os.path.exists(filename):
-            file_size_mb = os.path.getsize(filename) / (1024 * 1024)
-            
-            if file_size_mb > 2000:
-                os.remove(filename)
-                return
-            
-            platform = 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok'
-            await db.add_download(user.id, platform)
-            await ref.process_download_coins(user.id)
-            
-            try:
-                if audio_only:
-                    with open(filename, 'rb') as audio_file:
-                        await query.message.reply_audio(
-                            audio=audio_file,
-                            caption="✅ *Готово!*\n\n🎧 Вот твой аудиофайл",
-                            parse_mode=ParseMode.MARKDOWN,
-                            read_timeout=300,
-                            write_timeout=300
-                        )
-                elif file_size_mb > 50:
-                    await query.message.reply_document(
-                        document=open(filename, 'rb'),
-                        caption=f"✅ *Готово!*\n\n🎬 Видео ({file_size_mb:.1f} MB)",
-                        parse_mode=ParseMode.MARKDOWN,
-                        read_timeout=1800,
-                        write_timeout=1800
-                    )
-                else:
-                    with open(filename, 'rb') as video_file:
-                        await query.message.reply_video(
-                            video=video_file,
-                            caption="✅ *Готово!*",
-                            parse_mode=ParseMode.MARKDOWN,
-                            supports_streaming=True,
-                            read_timeout=300,
-                            write_timeout=300
-                        )
-            except Exception as e:
-                logger.error(f"Ошибка отправки файла: {e}")
-            finally:
-                if os.path.exists(filename):
-                    os.remove(filename)
+        file_size_mb = os.path.getsize(filename) / (1024 * 1024)
+        if file_size_mb > 2000:
+            return False
+        
+        if item['audio_only']:
+            with open(filename, 'rb') as audio_file:
+                sent = await query.message.reply_audio(
+                    audio=audio_file,
+                    caption=download_caption('audio', file_size_mb, mass=True),
+                    parse_mode=ParseMode.MARKDOWN,
+                    read_timeout=300,
+                    write_timeout=300
+                )
+        elif file_size_mb > 50:
+            sent = await query.message.reply_document(
+                document=open(filename, 'rb'),
+                caption=download_caption('document', file_size_mb, mass=True),
+                parse_mode=ParseMode.MARKDOWN,
+                read_timeout=1800,
+                write_timeout=1800
+            )
+        else:
+            with open(filename, 'rb') as video_file:
+                sent = await query.message.reply_video(
+                    video=video_file,
+                    caption=download_caption('video', file_size_mb, mass=True),
+                    parse_mode=ParseMode.MARKDOWN,
+                    supports_streaming=True,
+                    read_timeout=300,
+                    write_timeout=300
+                )
     except Exception as e:
-        logger.error(f"Ошибка загрузки: {e}")
+        logger.error(f"Ошибка отправки файла: {e}")
+        return False
+    finally:
+        item['filename'] = None
+        disk_cache.release(filename)
+    
+    await remember_sent_file(item['cache_key'], sent)
+    await commit_download(user.id, item['platform'], reservation)
+    await ref.process_download_coins(user.id)
+    return True
 
-async def check_sponsors_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    sponsors = await db.get_active_sponsors()
-    if not sponsors:
-        return True
+# В альбом (send_media_group) попадают видео и аудио до 50 MB; большие документы отправляются по одному
+MEDIA_GROUP_LIMIT = 10
+
+def album_eligible(item) -> bool:
+    if item['filename']:
+        return os.path.exists(item['filename']) and os.path.getsize(item['filename']) <= 50 * 1024 * 1024
+    return item['cached']['media_type'] == ('audio' if item['audio_only'] else 'video')
+
+async def deliver_mass_album(query, items: list, reservation=None) -> bool:
+    user = query.from_user
+    media = []
+    handles = []
+    try:
+        for item in items:
+            if item['filename']:
+                source = open(item['filename'], 'rb')
+                handles.append(source)
+            else:
+                source = item['cached']['file_id']
+            caption = download_caption('audio' if item['audio_only'] else 'video', 0, mass=True) if not media else None
+            if item['audio_only']:
+                media.append(InputMediaAudio(media=source, caption=caption, parse_mode=ParseMode.MARKDOWN))
+            else:
+                media.append(InputMediaVideo(media=source, caption=caption, parse_mode=ParseMode.MARKDOWN, supports_streaming=True))
+        sent = await query.message.reply_media_group(media=media, read_timeout=600, write_timeout=600)
+    except Exception as e:
+        logger.warning(f"Не удалось отправить альбом из {len(items)} файлов, отправляем по одному: {e}")
+        return False
+    finally:
+        for handle in handles:
+            handle.close()
+    
+    for item, message in zip(items, sent):
+        if item['filename']:
+            disk_cache.release(item['filename'])
+            item['filename'] = None
+            await remember_sent_file(item['cache_key'], message)
+        await commit_download(user.id, item['platform'], reservation)
+        await ref.process_download_coins(user.id)
+    return True
+
+async def run_mass_download(query, urls: list, quality: str, reservation=None) -> int:
+    status_msg = query.message
+    semaphore = asyncio.Semaphore(MASS_DOWNLOAD_CONCURRENCY)
+    tasks = [asyncio.create_task(prepare_mass_item(query.from_user.id, url, quality, semaphore)) for url in urls]
+    progress = {'delivered': 0, 'shown_at': 0.0}
+    
+    # Прогресс обновляется не чаще раза в MASS_PROGRESS_INTERVAL секунд, чтобы не упираться в лимиты Telegram
+    async def show_progress():
+        now = asyncio.get_running_loop().time()
+        if now - progress['shown_at'] < MASS_PROGRESS_INTERVAL:
+            return
+        progress['shown_at'] = now
+        ready = sum(1 for task in tasks if task.done())
+        try:
+            await status_msg.edit_text(
+                f"📦 *Массовая загрузка*\n\n"
+                f"Найдено видео: *{len(urls)}*\n"
+                f"Скачано: {ready}/{len(urls)}\n"
+                f"Отправлено: {progress['delivered']}/{len(urls)}\n\n"
+                f"⏳ Загружаю видео...",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except Exception:
+            pass
+    
+    album = []
     
-    current_sponsors_ids = '_'.join([str(s['id']) for s in sponsors])
+    async def flush_album():
+        if len(album) > 1 and await deliver_mass_album(query, album, reservation):
+            progress['delivered'] += len(album)
+        else:
+            for item in album:
+                if await deliver_mass_item(query, item, reservation):
+                    progress['delivered'] += 1
+        album.clear()
     
-    checked_sponsors = await db.check_user_subscribed_sponsors(user_id)
-    if checked_sponsors == current_sponsors_ids:
+    try:
+        for task in tasks:
+            # следующая ссылка ещё готовится — отправляем то, что уже накопилось
+            if not task.done() and album:
+                await flush_album()
+            while not task.done():
+                await asyncio.wait([task], timeout=MASS_PROGRESS_INTERVAL)
+                await show_progress()
+            item = task.result()
+            if item and album_eligible(item):
+                album.append(item)
+                if len(album) == MEDIA_GROUP_LIMIT:
+                    await flush_album()
+            elif item:
+                await flush_album()
+                if await deliver_mass_item(query, item, reservation):
+                    progress['delivered'] += 1
+            await show_progress()
+        await flush_album()
+    finally:
+        # при прерывании отменяем подготовку и возвращаем уже скачанные файлы в кэш
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.result() and task.result()['filename']:
+                disk_cache.release(task.result()['filename'])
+    
+    return progress['delivered']
+
+async def check_sponsors_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, gate: dict) -> bool:
+    if gate['sponsors_ok']:
         return True
     
     keyboard = []
-    for sponsor in sponsors:
+    for sponsor in gate['sponsors']:
         keyboard.append([InlineKeyboardButton(f"✅ Спонсор №{sponsor['position']}", url=sponsor['link'])])
     keyboard.append([InlineKeyboardButton("✅ Проверить подписку", callback_data=f"check_sponsor_{user_id}")])
     
@@ -732,10 +879,137 @@ async def check_sponsors_subscription(update: Update, context: ContextTypes.DEFA
     
     return False
 
-async def process_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
+def download_caption(media_type: str, file_size_mb: float, mass: bool = False) -> str:
+    if mass:
+        if media_type == 'audio':
+            return "✅ *Готово!*\n\n🎧 Вот твой аудиофайл"
+        if media_type == 'document':
+            return f"✅ *Готово!*\n\n🎬 Видео ({file_size_mb:.1f} MB)"
+        return "✅ *Готово!*"
+    if media_type == 'audio':
+        return "✅ *Готово!*\n\n🎧 Вот твой аудиофайл в формате MP3\n\nСпасибо, что пользуешься ⚡*MaxSaver*"
+    if media_type == 'document':
+        return f"✅ *Готово!*\n\n🎬 Видео ({file_size_mb:.1f} MB)\n\n📦 Отправлено как документ из-за большого размера\nВидео можно смотреть прямо в Telegram!\n\nСпасибо, что пользуешься ⚡*MaxSaver*"
+    return "✅ *Готово!*\n\n🎬 Вот твоё видео без водяных знаков\n\nСпасибо, что пользуешься ⚡*MaxSaver*"
+
+async def send_cached_file(message, cache_key: str, mass: bool = False, cached: dict = None) -> bool:
+    # Повторная отправка по file_id: без скачивания и без загрузки файла в Telegram.
+    # Уже найденную запись (массовая загрузка) передают в cached, чтобы не читать её и не считать попадание повторно
+    if cached is None:
+        cached = await db.get_cached_file(cache_key)
+    if not cached:
+        return False
+    
+    file_size_mb = (cached['file_size'] or 0) / (1024 * 1024)
+    caption = download_caption(cached['media_type'], file_size_mb, mass)
+    try:
+        if cached['media_type'] == 'audio':
+            await message.reply_audio(audio=cached['file_id'], caption=caption, parse_mode=ParseMode.MARKDOWN)
+        elif cached['media_type'] == 'document':
+            await message.reply_document(document=cached['file_id'], caption=caption, parse_mode=ParseMode.MARKDOWN)
+        else:
+            await message.reply_video(video=cached['file_id'], caption=caption, parse_mode=ParseMode.MARKDOWN, supports_streaming=True)
+        logger.info(f"Файл отправлен из кэша file_id: {cache_key}")
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось отправить файл по file_id ({cache_key}): {e}")
+        await db.delete_cached_file(cache_key)
+        return False
+
+async def remember_sent_file(cache_key: str, sent_message):
+    try:
+        for media_type in ('video', 'document', 'audio'):
+            media = getattr(sent_message, media_type, None)
+            if media:
+                await db.store_cached_file(cache_key, media.file_id, media.file_size, media_type)
+                return
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить file_id: {e}")
+
+async def send_limit_message(message, context: ContextTypes.DEFAULT_TYPE, next_slot_in):
+    keyboard = [[InlineKeyboardButton("💎 Открыть Plus+", callback_data="show_packages")]]
+    msg = await message.reply_text(
+        f"⚠️ *Лимит бесплатных загрузок исчерпан!*\n\n"
+        f"Бесплатный тариф: *{FREE_DOWNLOAD_LIMIT} видео* за 24 часа\n"
+        f"⏳ Следующая загрузка станет доступна через *{format_wait_time(next_slot_in)}*\n\n"
+        "🚀 Хочешь безлимит?\n"
+        "Подключи пакет 💎*Plus+* и скачивай сколько хочешь!",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=ParseMode.MARKDOWN
+    )
+    asyncio.create_task(delete_message_later(context, message.chat_id, msg.message_id, 30))
+
+async def reserve_download_quota(user_id: int, count: int):
+    # Возвращает (резерв или None для безлимита, сколько ссылок можно скачать)
+    reservation = await db.reserve_quota(user_id, count, FREE_DOWNLOAD_LIMIT)
+    if reservation is None:
+        return None, 0
+    if reservation['id'] is None:
+        return None, count
+    return reservation, reservation['slots']
+
+async def commit_download(user_id: int, platform: str, reservation):
+    if reservation:
+        await db.commit_quota(reservation['id'], user_id, platform)
+    else:
+        await db.add_download(user_id, platform)
+
+LOADING_TEXT = (
+    "⏳ *Скачиваю видео...*\n\n"
+    "⚡ Обычно это занимает 5-15 секунд\n"
+    "Пожалуйста, подожди немного..."
+)
+
+async def run_download(user_id: int, url: str, quality, audio_only: bool, loading_msg=None):
+    # Скачивание через планировщик; пока задача в очереди, в сообщении загрузки видна позиция
+    # Пользователи с активными пакетами идут приоритетной полосой
+    platform = 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok'
+    priority = bool(await db.get_active_features(user_id))
+    job = scheduler.submit(
+        user_id, platform,
+        lambda: downloader.download_video(url, quality, audio_only),
+        discard=disk_cache.release,
+        priority=priority
+    )
+    
+    shown_position = None
+    while not job.started.is_set() and not job.future.done():
+        position = job.position()
+        if loading_msg and position != shown_position:
+            try:
+                await loading_msg.edit_text(
+                    f"🕐 *Ты в очереди: {position}*\n\n"
+                    "Сейчас много загрузок, скачивание начнётся автоматически.\n"
+                    "Пожалуйста, подожди немного...",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            except Exception:
+                pass
+            shown_position = position
+        try:
+            await asyncio.wait_for(job.started.wait(), timeout=3)
+        except asyncio.TimeoutError:
+            pass
+    
+    if loading_msg and shown_position is not None:
+        try:
+            await loading_msg.edit_text(LOADING_TEXT, parse_mode=ParseMode.MARKDOWN)
+        except Exception:
+            pass
+    
+    return await job.result()
+
+def purge_preview_keys(user_data: dict):
+    for key in [k for k in user_data if isinstance(k, str) and k.startswith('preview_')]:
+        del user_data[key]
+
+async def process_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, gate: dict = None):
     user = update.effective_user
     
-    sponsors_ok = await check_sponsors_subscription(update, context, user.id)
+    if gate is None:
+        gate = await db.get_user_gate(user.id)
+    
+    sponsors_ok = await check_sponsors_subscription(update, context, user.id, gate)
     if not sponsors_ok:
         return
     
@@ -764,27 +1038,18 @@ async def process_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE,
         asyncio.create_task(delete_message_later(context, update.effective_chat.id, msg.message_id, 30))
         return
     
-    has_unlimited = await db.has_feature(user.id, 'unlimited')
+    has_unlimited = 'unlimited' in gate['features']
     if not has_unlimited:
-        download_count = await db.get_download_count_24h(user.id)
+        download_count = gate['download_count']
         if download_count >= FREE_DOWNLOAD_LIMIT:
-            keyboard = [[InlineKeyboardButton("💎 Открыть Plus+", callback_data="show_packages")]]
-            msg = await update.message.reply_text(
-                f"⚠️ *Лимит бесплатных загрузок исчерпан!*\n\n"
-                f"Бесплатный тариф: *{FREE_DOWNLOAD_LIMIT} видео* за 24 часа\n\n"
-                "🚀 Хочешь безлимит?\n"
-                "Подключи пакет 💎*Plus+* и скачивай сколько хочешь!",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
-            )
-            asyncio.create_task(delete_message_later(context, update.effective_chat.id, msg.message_id, 30))
+            await send_limit_message(update.message, context, gate['next_slot_in'])
             return
     
     download_id = str(uuid.uuid4())[:8]
     await db.store_pending_download(download_id, url, user.id)
     
     keyboard = []
-    has_4k = await db.has_feature(user.id, '4k')
+    has_4k = '4k' in gate['features']
     
     if info['platform'] == 'tiktok':
         if info.get('formats'):
@@ -814,29 +1079,29 @@ async def process_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE,
     text += f"⏱ *Длительность:* {duration_str}\n\n"
     text += "Выбери формат для скачивания 👇"
     
+    # id сообщений с превью нигде не читаются — убираем ключи, накопленные в user_data раньше
+    purge_preview_keys(context.user_data)
+    
     if info['thumbnail']:
         try:
-            preview_msg = await update.message.reply_photo(
+            await update.message.reply_photo(
                 photo=info['thumbnail'],
                 caption=text,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=reply_markup
             )
-            context.user_data[f'preview_{url}'] = preview_msg.message_id
         except:
-            preview_msg = await update.message.reply_text(
+            await update.message.reply_text(
                 text,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=reply_markup
             )
-            context.user_data[f'preview_{url}'] = preview_msg.message_id
     else:
-        preview_msg = await update.message.reply_text(
+        await update.message.reply_text(
             text,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
         )
-        context.user_data[f'preview_{url}'] = preview_msg.message_id
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -982,35 +1247,38 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         selected_quality = quality_map.get(quality_type, 'hd')
         
-        await query.edit_message_text(
-            f"📦 *Массовая загрузка*\n\n"
-            f"Найдено видео: *{len(urls)}*\n"
-            f"Обработано: 0/{len(urls)}\n\n"
-            f"⏳ Начинаем загрузку...",
-            parse_mode=ParseMode.MARKDOWN
-        )
+        reservation, allowed = await reserve_download_quota(user.id, len(urls))
+        if not allowed:
+            quota = await db.get_quota_status(user.id, FREE_DOWNLOAD_LIMIT)
+            await send_limit_message(query.message, context, quota['next_slot_in'])
+            return
+        skipped = len(urls) - allowed
+        urls = urls[:allowed]
         
         status_msg = query.message
         
-        for idx, url in enumerate(urls, 1):
-            try:
-                await status_msg.edit_text(
-                    f"📦 *Массовая загрузка*\n\n"
-                    f"Найдено видео: *{len(urls)}*\n"
-                    f"Обработано: {idx-1}/{len(urls)}\n\n"
-                    f"⏳ Загружаю видео {idx}...",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            except:
-                pass
-            
-            await process_mass_download_video(query, context, url, selected_quality)
+        delivered = 0
+        try:
+            await query.edit_message_text(
+                f"📦 *Массовая загрузка*\n\n"
+                f"Найдено видео: *{len(urls)}*\n"
+                f"Обработано: 0/{len(urls)}\n\n"
+                f"⏳ Начинаем загрузку...",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            delivered = await run_mass_download(query, urls, selected_quality, reservation)
+        finally:
+            # неиспользованные слоты (ошибки скачивания) возвращаем в лимит
+            if reservation:
+                await db.release_quota(reservation['id'])
         
+        skipped_text = f"⚠️ Пропущено из-за лимита: *{skipped}*\n" if skipped else ""
         try:
             await status_msg.edit_text(
                 f"✅ *Массовая загрузка завершена!*\n\n"
-                f"Всего загружено: *{len(urls)} видео*\n\n"
-                f"Все файлы отправлены выше 👆",
+                f"Всего загружено: *{delivered} из {len(urls)} видео*\n"
+                f"{skipped_text}"
+                f"\nВсе файлы отправлены выше 👆",
                 parse_mode=ParseMode.MARKDOWN
             )
             asyncio.create_task(delete_message_later(context, status_msg.chat_id, status_msg.message_id, 30))
@@ -1176,115 +1444,152 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             quality = parts[1]
             audio_only = False
         
-        await db.delete_pending_download(download_id)
+        # Слот лимита занимаем до начала скачивания, чтобы параллельные нажатия не обходили лимит
+        reservation, allowed = await reserve_download_quota(user.id, 1)
+        if not allowed:
+            quota = await db.get_quota_status(user.id, FREE_DOWNLOAD_LIMIT)
+            await send_limit_message(query.message, context, quota['next_slot_in'])
+            return
+        
+        delivered = False
+        try:
+            await db.delete_pending_download(download_id)
         
-        if url:
-            try:
-                await query.message.delete()
-            except:
-                pass
+            if url:
+                try:
+                    await query.message.delete()
+                except:
+                    pass
             
-            loading_msg = await query.message.reply_text(
-                "⏳ *Скачиваю видео...*\n\n"
-                "⚡ Обычно это занимает 5-15 секунд\n"
-                "Пожалуйста, подожди немного...",
-                parse_mode=ParseMode.MARKDOWN
-            )
+                loading_msg = await query.message.reply_text(LOADING_TEXT, parse_mode=ParseMode.MARKDOWN)
             
-            try:
-                filename = await downloader.download_video(url, quality, audio_only)
+                platform = 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok'
+                cache_key = downloader.delivery_key(url, quality, audio_only)
+            
+                try:
+                    if await send_cached_file(query.message, cache_key):
+                        delivered = True
+                        await commit_download(user.id, platform, reservation)
+                        await ref.process_download_coins(user.id)
+                        try:
+                            await loading_msg.delete()
+                        except Exception:
+                            pass
+                        return
                 
-                if filename and os.path.exists(filename):
-                    # Проверка размера файла
-                    file_size_mb = os.path.getsize(filename) / (1024 * 1024)
-                    logger.info(f"Downloaded file size: {file_size_mb:.2f} MB")
-                    
-                    # Для очень больших файлов (>2GB) - технический лимит
-                    if file_size_mb > 2000:
-                        os.remove(filename)
+                    try:
+                        filename = await run_download(user.id, url, quality, audio_only, loading_msg)
+                    except scheduler.QueueFull:
                         await loading_msg.edit_text(
-                            f"⚠️ *Файл слишком большой!*\n\n"
-                            f"📦 Размер: *{file_size_mb:.1f} MB*\n"
-                            f"🚫 Максимальный лимит: *2000 MB*\n\n"
-                            f"💡 Выбери меньшее качество (720p, 480p или 360p)",
+                            "🚦 *Сервер перегружен*\n\n"
+                            "Сейчас слишком много загрузок.\n"
+                            "Попробуй ещё раз через минуту.",
                             parse_mode=ParseMode.MARKDOWN
                         )
-                        asyncio.create_task(delete_message_later(context, query.message.chat_id, loading_msg.message_id, 40))
+                        asyncio.create_task(delete_message_later(context, query.message.chat_id, loading_msg.message_id, 30))
                         return
+                
+                    if filename and os.path.exists(filename):
+                        # Проверка размера файла
+                        file_size_mb = os.path.getsize(filename) / (1024 * 1024)
+                        logger.info(f"Downloaded file size: {file_size_mb:.2f} MB")
                     
-                    platform = 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok'
-                    await db.add_download(user.id, platform)
-                    
-                    await ref.process_download_coins(user.id)
+                        # Для очень больших файлов (>2GB) - технический лимит
+                        if file_size_mb > 2000:
+                            disk_cache.release(filename)
+                            await loading_msg.edit_text(
+                                f"⚠️ *Файл слишком большой!*\n\n"
+                                f"📦 Размер: *{file_size_mb:.1f} MB*\n"
+                                f"🚫 Максимальный лимит: *2000 MB*\n\n"
+                                f"💡 Выбери меньшее качество (720p, 480p или 360p)",
+                                parse_mode=ParseMode.MARKDOWN
+                            )
+                            asyncio.create_task(delete_message_later(context, query.message.chat_id, loading_msg.message_id, 40))
+                            return
                     
-                    try:
-                        if audio_only:
-                            logger.info("Отправка аудио файла...")
-                            with open(filename, 'rb') as audio_file:
-                                await query.message.reply_audio(
-                                    audio=audio_file,
-                                    caption="✅ *Готово!*\n\n🎧 Вот твой аудиофайл в формате MP3\n\nСпасибо, что пользуешься ⚡*MaxSaver*",
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    read_timeout=300,
-                                    write_timeout=300
-                                )
-                            logger.info("Аудио файл успешно отправлен")
-                        elif file_size_mb > 50:
-                            # Большие видео отправляем как документ (лимит 2GB вместо 50MB)
-                            logger.info(f"Отправка большого видео как документ ({file_size_mb:.1f} MB)...")
+                        try:
+                            if audio_only:
+                                logger.info("Отправка аудио файла...")
+                                with open(filename, 'rb') as audio_file:
+                                    sent = await query.message.reply_audio(
+                                        audio=audio_file,
+                                        caption=download_caption('audio', file_size_mb),
+                                        parse_mode=ParseMode.MARKDOWN,
+                                        read_timeout=300,
+                                        write_timeout=300
+                                    )
+                                logger.info("Аудио файл успешно отправлен")
+                            elif file_size_mb > 50:
+                                # Большие видео отправляем как документ (лимит 2GB вместо 50MB)
+                                logger.info(f"Отправка большого видео как документ ({file_size_mb:.1f} MB)...")
                             
-                            # Для очень больших файлов показываем прогресс
-                            if file_size_mb > 500:
-                                await loading_msg.edit_text(
-                                    f"📤 *Отправка файла ({file_size_mb:.1f} MB)*\n\n"
-                                    f"⏳ Это может занять несколько минут\n"
-                                    f"Пожалуйста, не закрывайте чат...",
-                                    parse_mode=ParseMode.MARKDOWN
-                                )
+                                # Для очень больших файлов показываем прогресс
+                                if file_size_mb > 500:
+                                    await loading_msg.edit_text(
+                                        f"📤 *Отправка файла ({file_size_mb:.1f} MB)*\n\n"
+                                        f"⏳ Это может занять несколько минут\n"
+                                        f"Пожалуйста, не закрывайте чат...",
+                                        parse_mode=ParseMode.MARKDOWN
+                                    )
                             
-                            # Отправляем файл по пути для больших размеров (не загружаем в память)
-                            await query.message.reply_document(
-                                document=open(filename, 'rb'),
-                                caption=f"✅ *Готово!*\n\n🎬 Видео ({file_size_mb:.1f} MB)\n\n📦 Отправлено как документ из-за большого размера\nВидео можно смотреть прямо в Telegram!\n\nСпасибо, что пользуешься ⚡*MaxSaver*",
-                                parse_mode=ParseMode.MARKDOWN,
-                                read_timeout=1800,
-                                write_timeout=1800,
-                                connect_timeout=300,
-                                pool_timeout=300
-                            )
-                            logger.info("Документ успешно отправлен")
-                        else:
-                            # Маленькие видео отправляем как видео
-                            logger.info("Отправка видео...")
-                            with open(filename, 'rb') as video_file:
-                                await query.message.reply_video(
-                                    video=video_file,
-                                    caption="✅ *Готово!*\n\n🎬 Вот твоё видео без водяных знаков\n\nСпасибо, что пользуешься ⚡*MaxSaver*",
+                                # Отправляем файл по пути для больших размеров (не загружаем в память)
+                                sent = await query.message.reply_document(
+                                    document=open(filename, 'rb'),
+                                    caption=download_caption('document', file_size_mb),
                                     parse_mode=ParseMode.MARKDOWN,
-                                    supports_streaming=True,
-                                    read_timeout=300,
-                                    write_timeout=300
+                                    read_timeout=1800,
+                                    write_timeout=1800,
+                                    connect_timeout=300,
+                                    pool_timeout=300
                                 )
-                            logger.info("Видео успешно отправлено")
-                    except Exception as send_error:
-                        logger.error(f"Ошибка при отправке файла: {str(send_error)}", exc_info=True)
+                                logger.info("Документ успешно отправлен")
+                            else:
+                                # Маленькие видео отправляем как видео
+                                logger.info("Отправка видео...")
+                                with open(filename, 'rb') as video_file:
+                                    sent = await query.message.reply_video(
+                                        video=video_file,
+                                        caption=download_caption('video', file_size_mb),
+                                        parse_mode=ParseMode.MARKDOWN,
+                                        supports_streaming=True,
+                                        read_timeout=300,
+                                        write_timeout=300
+                                    )
+                                logger.info("Видео успешно отправлено")
+                        except Exception as send_error:
+                            logger.error(f"Ошибка при отправке файла: {str(send_error)}", exc_info=True)
+                            await loading_msg.edit_text(
+                                "🚫 *Ошибка при отправке файла*\n\n"
+                                "Возможно, файл слишком большой или проблемы с сетью.\n"
+                                "Попробуй выбрать меньшее качество.",
+                                parse_mode=ParseMode.MARKDOWN
+                            )
+                            raise
+                        finally:
+                            disk_cache.release(filename)
+                    
+                        delivered = True
+                        await remember_sent_file(cache_key, sent)
+                        await commit_download(user.id, platform, reservation)
+                        await ref.process_download_coins(user.id)
+                    
+                        try:
+                            await loading_msg.delete()
+                        except Exception as del_error:
+                            logger.warning(f"Не удалось удалить сообщение загрузки: {del_error}")
+                    else:
                         await loading_msg.edit_text(
-                            "🚫 *Ошибка при отправке файла*\n\n"
-                            "Возможно, файл слишком большой или проблемы с сетью.\n"
-                            "Попробуй выбрать меньшее качество.",
+                            "🚫 *Ошибка при загрузке*\n\n"
+                            "Возможные причины:\n"
+                            "• Видео недоступно\n"
+                            "• Слишком большой размер файла\n"
+                            "• Проблемы на сервере\n\n"
+                            "⚙️ Попробуй позже или выбери другое качество",
                             parse_mode=ParseMode.MARKDOWN
                         )
-                        raise
-                    finally:
-                        if os.path.exists(filename):
-                            logger.info(f"Удаление временного файла: {filename}")
-                            os.remove(filename)
-                    
-                    try:
-                        await loading_msg.delete()
-                    except Exception as del_error:
-                        logger.warning(f"Не удалось удалить сообщение загрузки: {del_error}")
-                else:
+                        asyncio.create_task(delete_message_later(context, query.message.chat_id, loading_msg.message_id, 30))
+                except Exception as e:
+                    print(f"Download error: {e}")
                     await loading_msg.edit_text(
                         "🚫 *Ошибка при загрузке*\n\n"
                         "Возможные причины:\n"
@@ -1295,18 +1600,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         parse_mode=ParseMode.MARKDOWN
                     )
                     asyncio.create_task(delete_message_later(context, query.message.chat_id, loading_msg.message_id, 30))
-            except Exception as e:
-                print(f"Download error: {e}")
-                await loading_msg.edit_text(
-                    "🚫 *Ошибка при загрузке*\n\n"
-                    "Возможные причины:\n"
-                    "• Видео недоступно\n"
-                    "• Слишком большой размер файла\n"
-                    "• Проблемы на сервере\n\n"
-                    "⚙️ Попробуй позже или выбери другое качество",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                asyncio.create_task(delete_message_later(context, query.message.chat_id, loading_msg.message_id, 30))
+        finally:
+            # слот возвращается при любой ошибке до доставки, в том числе когда ссылки нет
+            if reservation and not delivered:
+                await db.release_quota(reservation['id'])
     
     elif data.startswith('admin_') and user.id in ADMIN_IDS:
         if data == 'admin_send_push':
@@ -1577,31 +1874,69 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await db.update_subscription_expiry(target_id, feature, days)
         await update.message.reply_text(f"✅ Функция {feature} продлена на {days} дней для пользователя {target_id}")
 
+async def on_shutdown():
+    logger.info("Закрытие пула соединений с базой данных...")
+    await disk_cache.flush_index()
+    await downloader.close_http_client()
+    await db.close_db()
+    ytdlp_worker.shutdown_pool()
+
+# Общая сборка приложения для polling (main) и вебхука (app.py)
+def build_application() -> Application:
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(updates.PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(PostgresPersistence())
+        .build()
+    )
+    
+    # повторно доставленные апдейты отбрасываются до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, updates.drop_duplicate_update), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(MessageHandler(filters.Regex('^(📌 Pinterest|🎵 TikTok|📦 Массовая загрузка|💎 Plus\+|👤 My Account|🔧 Admin Panel)$'), button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CallbackQueryHandler(callback_handler))
+    return application
+
+# run_polling сам запускает event loop, поэтому внутри asyncio.run приложение запускается вручную
 async def main():
+    if not TELEGRAM_TOKEN:
+        logger.error("TELEGRAM_TOKEN не установлен! Проверьте переменные окружения.")
+        return
+    
     try:
-        if not TELEGRAM_TOKEN:
-            logger.error("TELEGRAM_TOKEN не установлен! Проверьте переменные окружения.")
-            return
-        
         logger.info("Инициализация базы данных...")
         await db.init_db()
         await ref.init_referral_tables()
+        await downloader.init_http_client()
+        ytdlp_worker.start_pool()
         
         logger.info("Создание приложения Telegram...")
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        application = build_application()
         
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("admin", admin_command))
-        application.add_handler(MessageHandler(filters.Regex('^(📌 Pinterest|🎵 TikTok|📦 Массовая загрузка|💎 Plus\+|👤 My Account|🔧 Admin Panel)$'), button_handler))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_handler(CallbackQueryHandler(callback_handler))
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
         
-        logger.info("Бот запущен и готов к работе!")
-        await application.run_polling(allowed_updates=Update.ALL_TYPES)
+        async with application:
+            await application.start()
+            try:
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                logger.info("Бот запущен и готов к работе!")
+                await stop.wait()
+            finally:
+                if application.updater.running:
+                    await application.updater.stop()
+                if application.running:
+                    await application.stop()
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {str(e)}", exc_info=True)
         raise
+    finally:
+        await on_shutdown()
 
 if __name__ == '__main__':
     asyncio.run(main())
-
@@ -59,3 +59,92 @@ PACKAGES = {
         'features': ['4k']
     }
 }
+
+# Планировщик скачиваний: общее число одновременных скачиваний и лимиты по платформам
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '6'))
+DOWNLOAD_PLATFORM_WORKERS = {
+    'tiktok': int(os.getenv('TIKTOK_DOWNLOAD_WORKERS', '4')),
+    'pinterest': int(os.getenv('PINTEREST_DOWNLOAD_WORKERS', '2')),
+}
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv('DOWNLOAD_QUEUE_LIMIT', '200'))
+
+# Приоритетная полоса для пользователей с активными пакетами: часть воркеров доступна только им,
+# бесплатные задачи получают остаток и при перегрузке отклоняются
+DOWNLOAD_PRIORITY_RESERVED = int(os.getenv('DOWNLOAD_PRIORITY_RESERVED', '2'))
+DOWNLOAD_FREE_QUEUE_LIMIT = int(os.getenv('DOWNLOAD_FREE_QUEUE_LIMIT', '100'))
+DOWNLOAD_FREE_MAX_WAIT = float(os.getenv('DOWNLOAD_FREE_MAX_WAIT', '300'))
+
+# Массовая загрузка: сколько ссылок готовится параллельно и как часто обновляется прогресс (сек)
+MASS_DOWNLOAD_CONCURRENCY = int(os.getenv('MASS_DOWNLOAD_CONCURRENCY', '3'))
+MASS_PROGRESS_INTERVAL = float(os.getenv('MASS_PROGRESS_INTERVAL', '2'))
+
+# Вебхук: адрес сервиса и секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', 'https://max-7ftv.onrender.com')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Обработка апдейтов вебхука из очереди в Postgres: сколько апдейтов одного инстанса обрабатывается параллельно
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+UPDATE_POLL_INTERVAL = float(os.getenv('UPDATE_POLL_INTERVAL', '1'))
+# Сколько апдейтов инстанс держит взятыми из очереди, включая ждущие предыдущий апдейт того же пользователя
+UPDATE_MAX_CLAIMED = int(os.getenv('UPDATE_MAX_CLAIMED', '256'))
+
+# Сколько апдейтов разных пользователей обрабатывается одновременно; апдейты одного пользователя — по очереди
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Как часто (сек) изменения user_data записываются в Postgres
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '1'))
+
+# Пул соединений с Postgres
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '10'))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_MAX_INACTIVE_LIFETIME', '300'))
+
+# Кэш активных функций пользователя
+FEATURES_CACHE_SIZE = int(os.getenv('FEATURES_CACHE_SIZE', '10000'))
+FEATURES_CACHE_MAX_TTL = float(os.getenv('FEATURES_CACHE_MAX_TTL', '300'))
+
+# Через сколько минут истекает незавершённый резерв бесплатного лимита
+QUOTA_RESERVATION_TTL_MINUTES = int(os.getenv('QUOTA_RESERVATION_TTL_MINUTES', '30'))
+
+# Очередь апдейтов в Postgres: аренда взятого апдейта (продлевается каждую треть срока, пока апдейт
+# обрабатывается) и число попыток
+UPDATE_QUEUE_LEASE_SECONDS = int(os.getenv('UPDATE_QUEUE_LEASE_SECONDS', '60'))
+UPDATE_QUEUE_MAX_ATTEMPTS = int(os.getenv('UPDATE_QUEUE_MAX_ATTEMPTS', '3'))
+
+# Отсев повторных апдейтов: память процесса и сколько часов хранить update_id в Postgres
+UPDATE_DEDUP_CACHE_SIZE = int(os.getenv('UPDATE_DEDUP_CACHE_SIZE', '20000'))
+UPDATE_DEDUP_CACHE_TTL = float(os.getenv('UPDATE_DEDUP_CACHE_TTL', '3600'))
+PROCESSED_UPDATES_TTL_HOURS = int(os.getenv('PROCESSED_UPDATES_TTL_HOURS', '24'))
+
+# Кэш версий сессий user_data в памяти процесса
+SESSION_VERSIONS_CACHE_SIZE = int(os.getenv('SESSION_VERSIONS_CACHE_SIZE', '50000'))
+SESSION_VERSIONS_CACHE_TTL = float(os.getenv('SESSION_VERSIONS_CACHE_TTL', '86400'))
+
+# Кэш метаданных видео и ответов TikWM (сек)
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '5000'))
+METADATA_CACHE_TTL = float(os.getenv('METADATA_CACHE_TTL', '21600'))
+METADATA_SHORT_TTL = float(os.getenv('METADATA_SHORT_TTL', '300'))
+TIKWM_URL_TTL = float(os.getenv('TIKWM_URL_TTL', '1800'))
+
+# Общий HTTP-клиент загрузчика
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_PER_HOST_LIMIT = int(os.getenv('HTTP_PER_HOST_LIMIT', '10'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+
+# Дисковый кэш скачанных файлов. Индекс и бюджет у каждого процесса свои: при N процессах (вебхук, воркеры)
+# с общим DOWNLOAD_DIR кэш занимает до N × DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS, а файлы, закэшированные
+# другим живым процессом, не дают попаданий
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', 'downloads')
+DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS = int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS', str(2 * 1024 ** 3)))
+# Через сколько секунд файлы без владельца (умерший процесс на другом хосте, каталоги вне индексов) удаляются
+DOWNLOAD_CACHE_STALE_SECONDS = float(os.getenv('DOWNLOAD_CACHE_STALE_SECONDS', '86400'))
+
+# Пул процессов yt-dlp: число процессов, таймауты (сек) и сколько вызовов живёт один YoutubeDL
+YTDLP_WORKERS = int(os.getenv('YTDLP_WORKERS', '2'))
+YTDLP_INFO_TIMEOUT = float(os.getenv('YTDLP_INFO_TIMEOUT', '60'))
+YTDLP_DOWNLOAD_TIMEOUT = float(os.getenv('YTDLP_DOWNLOAD_TIMEOUT', '900'))
+YTDLP_INSTANCE_MAX_USES = int(os.getenv('YTDLP_INSTANCE_MAX_USES', '50'))
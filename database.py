@@ -3,11 +3,54 @@ import asyncpg
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict
 import json
+import logging
+import uuid
+from ttl_cache import TTLCache
+from config import (
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_ACQUIRE_TIMEOUT, DB_STATEMENT_CACHE_SIZE, DB_MAX_INACTIVE_LIFETIME,
+    FEATURES_CACHE_SIZE, FEATURES_CACHE_MAX_TTL, QUOTA_RESERVATION_TTL_MINUTES,
+    UPDATE_QUEUE_LEASE_SECONDS, UPDATE_QUEUE_MAX_ATTEMPTS, PROCESSED_UPDATES_TTL_HOURS,
+)
+
+logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+_pool: Optional[asyncpg.Pool] = None
+
+# Кэш активных функций пользователя. Запись живёт до ближайшего expires_at
+# (но не дольше FEATURES_CACHE_MAX_TTL) и сбрасывается при любом изменении подписок.
+_features_cache = TTLCache(FEATURES_CACHE_SIZE, FEATURES_CACHE_MAX_TTL)
+_features_epoch = 0
+
 async def init_db():
-    conn = await asyncpg.connect(DATABASE_URL)
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        )
+    async with db() as conn:
+        # Несколько инстансов могут стартовать одновременно — схему меняет только один
+        await conn.execute('SELECT pg_advisory_lock($1)', MIGRATIONS_LOCK_ID)
+        try:
+            await _create_tables(conn)
+            await _run_migrations(conn)
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATIONS_LOCK_ID)
+    await cleanup_metadata_cache()
+    await cleanup_processed_updates()
+
+async def close_db():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+async def _create_tables(conn):
     await conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
@@ -107,225 +150,582 @@ async def init_db():
         )
     ''')
     await conn.execute('INSERT INTO statistics (id) VALUES (1) ON CONFLICT (id) DO NOTHING')
-    await conn.close()
 
-# универсальная функция подключения
+# Версионированные миграции схемы: (версия, описание, список SQL).
+# Применённые версии хранятся в schema_version, новые миграции добавляются только в конец.
+MIGRATIONS_LOCK_ID = 7_301_245_001
+
+MIGRATIONS = [
+    (1, 'индексы для горячих выборок', [
+        'CREATE INDEX IF NOT EXISTS idx_downloads_user_time ON downloads (user_id, download_time)',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_expires ON subscriptions (user_id, expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_push_recipients_push_id ON push_recipients (push_id)',
+        'CREATE INDEX IF NOT EXISTS idx_pending_downloads_created_at ON pending_downloads (created_at)',
+    ]),
+    (2, 'уникальный payment_id', [
+        # старые дубли мешают построить индекс: оставляем успешный платёж, иначе самый ранний,
+        # а остальные строки переносим в payments_duplicates, чтобы их можно было проверить вручную
+        '''
+        CREATE TABLE IF NOT EXISTS payments_duplicates (
+            id INTEGER,
+            user_id BIGINT,
+            package_key TEXT,
+            amount REAL,
+            payment_id TEXT,
+            status TEXT,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        WITH dup AS (
+            DELETE FROM payments WHERE id IN (
+                SELECT id FROM (
+                    SELECT id,ROW_NUMBER() OVER (PARTITION BY payment_id ORDER BY status='succeeded' DESC,id) AS rn
+                    FROM payments WHERE payment_id IS NOT NULL
+                ) ranked WHERE rn>1
+            )
+            RETURNING id,user_id,package_key,amount,payment_id,status,created_at
+        )
+        INSERT INTO payments_duplicates (id,user_id,package_key,amount,payment_id,status,created_at)
+        SELECT id,user_id,package_key,amount,payment_id,status,created_at FROM dup
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_payment_id ON payments (payment_id)',
+    ]),
+    (3, 'почасовые счётчики скачиваний для лимита за 24 часа', [
+        '''
+        CREATE TABLE IF NOT EXISTS download_quota (
+            user_id BIGINT,
+            bucket_start TIMESTAMP,
+            downloads INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, bucket_start)
+        )
+        ''',
+        '''
+        INSERT INTO download_quota (user_id, bucket_start, downloads)
+        SELECT user_id, date_trunc('hour', download_time), COUNT(*)
+        FROM downloads WHERE download_time > LOCALTIMESTAMP - INTERVAL '25 hours'
+        GROUP BY 1, 2
+        ON CONFLICT (user_id, bucket_start) DO NOTHING
+        ''',
+    ]),
+    (4, 'резервирование слотов лимита до начала скачивания', [
+        '''
+        CREATE TABLE IF NOT EXISTS quota_reservations (
+            id TEXT PRIMARY KEY,
+            user_id BIGINT,
+            slots INTEGER,
+            expires_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_quota_reservations_user ON quota_reservations (user_id, expires_at)',
+    ]),
+    (5, 'кэш метаданных видео', [
+        '''
+        CREATE TABLE IF NOT EXISTS video_metadata_cache (
+            url_key TEXT PRIMARY KEY,
+            info JSONB,
+            expires_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_video_metadata_cache_expires ON video_metadata_cache (expires_at)',
+    ]),
+    (6, 'кэш file_id отправленных в Telegram файлов', [
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_file_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_id TEXT,
+            file_size BIGINT,
+            media_type TEXT,
+            hits INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (7, 'очередь входящих апдейтов вебхука', [
+        '''
+        CREATE TABLE IF NOT EXISTS update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            update_id BIGINT,
+            payload JSONB NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            available_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_update_queue_available ON update_queue (available_at, id)',
+    ]),
+    (8, 'уже обработанные update_id для отсева повторов', [
+        '''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_processed_updates_seen_at ON processed_updates (seen_at)',
+    ]),
+    (9, 'user_data бота, общий для всех воркеров', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            version BIGINT DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (10, 'токен аренды апдейта в очереди', [
+        'ALTER TABLE update_queue ADD COLUMN IF NOT EXISTS lease_token UUID',
+    ]),
+    (11, 'аренда, под которой апдейт отмечен обработанным', [
+        'ALTER TABLE processed_updates ADD COLUMN IF NOT EXISTS queue_id BIGINT',
+        'ALTER TABLE processed_updates ADD COLUMN IF NOT EXISTS lease_token UUID',
+    ]),
+]
+
+async def _run_migrations(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    applied = {r['version'] for r in await conn.fetch('SELECT version FROM schema_version')}
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        async with conn.transaction():
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute('INSERT INTO schema_version (version, description) VALUES ($1, $2)', version, description)
+        logger.info(f"Применена миграция {version}: {description}")
+
+# универсальная функция подключения: соединение из общего пула
 def db():
-    return asyncpg.connect(DATABASE_URL)
+    if _pool is None:
+        raise RuntimeError("Пул соединений не инициализирован, сначала вызовите init_db()")
+    return _pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
 
 async def add_user(user_id: int, username: Optional[str] = None):
-    conn = await db()
-    await conn.execute('''INSERT INTO users (user_id, username) VALUES ($1, $2)
-        ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username''', user_id, username)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('''INSERT INTO users (user_id, username) VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username''', user_id, username)
 
 async def is_user_blocked(user_id: int) -> bool:
-    conn = await db()
-    row = await conn.fetchrow('SELECT is_blocked FROM users WHERE user_id=$1', user_id)
-    await conn.close()
+    async with db() as conn:
+        row = await conn.fetchrow('SELECT is_blocked FROM users WHERE user_id=$1', user_id)
     return row and row['is_blocked'] == 1
 
+# Лимит за 24 часа считается по почасовым корзинам download_quota (не больше 25 строк на пользователя).
+# Корзина учитывается, пока её час пересекается с последними 24 часами (bucket_start + 1 час > сейчас - 24 часа),
+# то есть освобождается через 25 часов после начала своего часа — раньше 24 часов скачивание не освобождает слот.
+QUOTA_WINDOW_SQL = "bucket_start > LOCALTIMESTAMP - INTERVAL '25 hours'"
+QUOTA_NEXT_SLOT_SQL = "MIN(bucket_start) + INTERVAL '25 hours' - LOCALTIMESTAMP"
+
+# Незавершённые резервы тоже занимают лимит; зависшие (после падения процесса) истекают сами
+RESERVED_SLOTS_SQL = "SELECT COALESCE(SUM(slots),0) FROM quota_reservations WHERE user_id=$1 AND expires_at > LOCALTIMESTAMP"
+
+ADD_DOWNLOAD_SQL = f'''
+    WITH d AS (
+        INSERT INTO downloads (user_id, platform) VALUES ($1,$2)
+    ), q AS (
+        INSERT INTO download_quota (user_id, bucket_start, downloads)
+        VALUES ($1, date_trunc('hour', LOCALTIMESTAMP), 1)
+        ON CONFLICT (user_id, bucket_start) DO UPDATE SET downloads = download_quota.downloads + 1
+    ), old AS (
+        DELETE FROM download_quota WHERE user_id=$1 AND NOT ({QUOTA_WINDOW_SQL})
+    )
+    UPDATE statistics SET total_downloads=total_downloads+1 WHERE id=1
+'''
+
 async def get_download_count_24h(user_id: int) -> int:
-    conn = await db()
-    time_24h_ago = datetime.now() - timedelta(hours=24)
-    row = await conn.fetchrow('SELECT COUNT(*) AS c FROM downloads WHERE user_id=$1 AND download_time > $2', user_id, time_24h_ago)
-    await conn.close()
+    async with db() as conn:
+        row = await conn.fetchrow(f'SELECT COALESCE(SUM(downloads),0) AS c FROM download_quota WHERE user_id=$1 AND {QUOTA_WINDOW_SQL}', user_id)
     return row['c'] if row else 0
 
+async def get_quota_status(user_id: int, limit: int) -> Dict:
+    async with db() as conn:
+        row = await conn.fetchrow(f'''
+            SELECT COALESCE(SUM(downloads),0) + ({RESERVED_SLOTS_SQL}) AS used,
+                   {QUOTA_NEXT_SLOT_SQL} AS next_slot_in
+            FROM download_quota WHERE user_id=$1 AND {QUOTA_WINDOW_SQL}
+        ''', user_id)
+    return {'used': row['used'], 'remaining': max(limit - row['used'], 0), 'next_slot_in': row['next_slot_in']}
+
 async def add_download(user_id: int, platform: str):
-    conn = await db()
-    await conn.execute('INSERT INTO downloads (user_id, platform) VALUES ($1,$2)', user_id, platform)
-    await conn.execute('UPDATE statistics SET total_downloads=total_downloads+1 WHERE id=1')
-    await conn.close()
+    async with db() as conn:
+        # запись в историю, счётчик текущего часа, очистка старых корзин и статистика — одним запросом
+        await conn.execute(ADD_DOWNLOAD_SQL, user_id, platform)
+
+# Атомарно занимает до n слотов лимита до начала скачивания.
+# Возвращает {'id', 'slots'} или None, если свободных слотов нет; при подписке unlimited резерв
+# не создаётся и возвращается {'id': None, 'slots': n}. Подписка читается здесь, а не из кэша функций:
+# оплата могла пройти на другом инстансе, кэш которого этот процесс не видит.
+async def reserve_quota(user_id: int, n: int, limit: int) -> Optional[Dict]:
+    async with db() as conn:
+        async with conn.transaction():
+            if await conn.fetchval("SELECT 1 FROM subscriptions WHERE user_id=$1 AND feature='unlimited' AND expires_at>NOW() LIMIT 1", user_id):
+                return {'id': None, 'slots': n}
+            # транзакционная advisory-блокировка сериализует параллельные резервы одного пользователя,
+            # даже если строки в users ещё нет; ключ с префиксом не пересекается с блокировкой миграций
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtextextended('quota:' || $1::bigint, 0))", user_id)
+            await conn.execute('DELETE FROM quota_reservations WHERE user_id=$1 AND expires_at <= LOCALTIMESTAMP', user_id)
+            used = await conn.fetchval(f'''
+                SELECT (SELECT COALESCE(SUM(downloads),0) FROM download_quota WHERE user_id=$1 AND {QUOTA_WINDOW_SQL})
+                     + ({RESERVED_SLOTS_SQL})
+            ''', user_id)
+            slots = min(n, limit - used)
+            if slots <= 0:
+                return None
+            reservation_id = uuid.uuid4().hex
+            await conn.execute(
+                'INSERT INTO quota_reservations (id, user_id, slots, expires_at) VALUES ($1,$2,$3,LOCALTIMESTAMP + $4 * INTERVAL \'1 minute\')',
+                reservation_id, user_id, slots, QUOTA_RESERVATION_TTL_MINUTES)
+    return {'id': reservation_id, 'slots': slots}
+
+# Переводит один зарезервированный слот в засчитанное скачивание
+async def commit_quota(reservation_id: str, user_id: int, platform: str):
+    async with db() as conn:
+        async with conn.transaction():
+            await conn.execute('UPDATE quota_reservations SET slots=slots-1 WHERE id=$1', reservation_id)
+            await conn.execute('DELETE FROM quota_reservations WHERE id=$1 AND slots<=0', reservation_id)
+            await conn.execute(ADD_DOWNLOAD_SQL, user_id, platform)
+
+# Возвращает все неиспользованные слоты резерва
+async def release_quota(reservation_id: str):
+    async with db() as conn:
+        await conn.execute('DELETE FROM quota_reservations WHERE id=$1', reservation_id)
+
+def _cache_features(user_id: int, features: List[str], soonest_expiry: Optional[datetime], epoch: int):
+    # подписки могли измениться, пока шёл запрос — тогда не кэшируем устаревший результат
+    if epoch != _features_epoch:
+        return
+    ttl = (soonest_expiry - datetime.now()).total_seconds() if soonest_expiry else None
+    _features_cache.set(user_id, frozenset(features), ttl)
+
+def invalidate_features(user_id: int):
+    global _features_epoch
+    _features_epoch += 1
+    _features_cache.pop(user_id)
+
+def get_features_cache_stats() -> Dict:
+    return _features_cache.stats()
 
 async def get_active_features(user_id: int) -> List[str]:
-    conn = await db()
-    rows = await conn.fetch('SELECT DISTINCT feature FROM subscriptions WHERE user_id=$1 AND expires_at>NOW()', user_id)
-    await conn.close()
-    return [r['feature'] for r in rows]
+    cached = _features_cache.get(user_id)
+    if cached is not None:
+        return list(cached)
+    epoch = _features_epoch
+    async with db() as conn:
+        rows = await conn.fetch('SELECT feature, MIN(expires_at) AS expires_at FROM subscriptions WHERE user_id=$1 AND expires_at>NOW() GROUP BY feature', user_id)
+    features = [r['feature'] for r in rows]
+    _cache_features(user_id, features, min((r['expires_at'] for r in rows), default=None), epoch)
+    return features
 
 async def has_feature(user_id: int, feature: str) -> bool:
     return feature in await get_active_features(user_id)
 
 async def get_user_subscriptions(user_id: int) -> List[Dict]:
-    conn = await db()
-    rows = await conn.fetch('SELECT feature, expires_at FROM subscriptions WHERE user_id=$1 AND expires_at>NOW() ORDER BY expires_at DESC', user_id)
-    await conn.close()
+    async with db() as conn:
+        rows = await conn.fetch('SELECT feature, expires_at FROM subscriptions WHERE user_id=$1 AND expires_at>NOW() ORDER BY expires_at DESC', user_id)
     return [{'feature':r['feature'],'expires_at':r['expires_at']} for r in rows]
 
 async def add_subscription(user_id: int, features: List[str], duration_days: int):
-    conn = await db()
-    expires_at = datetime.now() + timedelta(days=duration_days)
-    for f in features:
-        await conn.execute('INSERT INTO subscriptions (user_id, feature, expires_at) VALUES ($1,$2,$3)', user_id, f, expires_at)
-    await conn.close()
+    async with db() as conn:
+        expires_at = datetime.now() + timedelta(days=duration_days)
+        for f in features:
+            await conn.execute('INSERT INTO subscriptions (user_id, feature, expires_at) VALUES ($1,$2,$3)', user_id, f, expires_at)
+    invalidate_features(user_id)
 
 async def create_payment(user_id: int, package_key: str, amount: float, payment_id: str):
-    conn = await db()
-    await conn.execute('INSERT INTO payments (user_id, package_key, amount, payment_id, status) VALUES ($1,$2,$3,$4,$5)', user_id, package_key, amount, payment_id, 'pending')
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('INSERT INTO payments (user_id, package_key, amount, payment_id, status) VALUES ($1,$2,$3,$4,$5)', user_id, package_key, amount, payment_id, 'pending')
 
 async def update_payment_status(payment_id: str, status: str):
-    conn = await db()
-    await conn.execute('UPDATE payments SET status=$1 WHERE payment_id=$2', status, payment_id)
-    if status=='succeeded':
-        await conn.execute('UPDATE statistics SET total_revenue=total_revenue+(SELECT amount FROM payments WHERE payment_id=$1) WHERE id=1', payment_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('UPDATE payments SET status=$1 WHERE payment_id=$2', status, payment_id)
+        if status=='succeeded':
+            await conn.execute('UPDATE statistics SET total_revenue=total_revenue+(SELECT amount FROM payments WHERE payment_id=$1) WHERE id=1', payment_id)
 
 async def get_payment(payment_id: str) -> Optional[Dict]:
-    conn = await db()
-    row = await conn.fetchrow('SELECT user_id,package_key,amount,status FROM payments WHERE payment_id=$1', payment_id)
-    await conn.close()
+    async with db() as conn:
+        row = await conn.fetchrow('SELECT user_id,package_key,amount,status FROM payments WHERE payment_id=$1', payment_id)
     if not row: return None
     return dict(row)
 
 async def get_statistics() -> Dict:
-    conn = await db()
-    row = await conn.fetchrow('SELECT total_downloads,total_revenue FROM statistics WHERE id=1')
-    await conn.close()
+    async with db() as conn:
+        row = await conn.fetchrow('SELECT total_downloads,total_revenue FROM statistics WHERE id=1')
     return {'total_downloads': row['total_downloads'] if row else 0, 'total_revenue': row['total_revenue'] if row else 0}
 
 async def block_user(user_id:int):
-    conn = await db()
-    await conn.execute('UPDATE users SET is_blocked=1 WHERE user_id=$1', user_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('UPDATE users SET is_blocked=1 WHERE user_id=$1', user_id)
 
 async def unblock_user(user_id:int):
-    conn = await db()
-    await conn.execute('UPDATE users SET is_blocked=0 WHERE user_id=$1', user_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('UPDATE users SET is_blocked=0 WHERE user_id=$1', user_id)
 
 async def store_pending_download(download_id:str,url:str,user_id:int):
-    conn = await db()
-    await conn.execute('INSERT INTO pending_downloads(download_id,url,user_id) VALUES($1,$2,$3) ON CONFLICT(download_id) DO UPDATE SET url=EXCLUDED.url,user_id=EXCLUDED.user_id',download_id,url,user_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('INSERT INTO pending_downloads(download_id,url,user_id) VALUES($1,$2,$3) ON CONFLICT(download_id) DO UPDATE SET url=EXCLUDED.url,user_id=EXCLUDED.user_id',download_id,url,user_id)
 
 async def get_pending_download(download_id:str)->Optional[Dict]:
-    conn = await db()
-    row = await conn.fetchrow('SELECT url,user_id FROM pending_downloads WHERE download_id=$1',download_id)
-    await conn.close()
+    async with db() as conn:
+        row = await conn.fetchrow('SELECT url,user_id FROM pending_downloads WHERE download_id=$1',download_id)
     return dict(row) if row else None
 
 async def delete_pending_download(download_id:str):
-    conn = await db()
-    await conn.execute('DELETE FROM pending_downloads WHERE download_id=$1',download_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('DELETE FROM pending_downloads WHERE download_id=$1',download_id)
+
+# Возвращает (найдено, info, оставшийся TTL в секундах); info=None — закэшированный отрицательный результат
+async def get_cached_metadata(url_key:str):
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT info,EXTRACT(EPOCH FROM expires_at-LOCALTIMESTAMP) AS ttl FROM video_metadata_cache WHERE url_key=$1 AND expires_at>LOCALTIMESTAMP',url_key)
+    if not row:
+        return False,None,0
+    return True,(json.loads(row['info']) if row['info'] is not None else None),float(row['ttl'])
+
+async def store_cached_metadata(url_key:str,info:Optional[Dict],ttl_seconds:float):
+    async with db() as conn:
+        await conn.execute('''INSERT INTO video_metadata_cache(url_key,info,expires_at)
+            VALUES($1,$2::jsonb,LOCALTIMESTAMP+$3*INTERVAL '1 second')
+            ON CONFLICT(url_key) DO UPDATE SET info=EXCLUDED.info,expires_at=EXCLUDED.expires_at''',
+            url_key,json.dumps(info) if info is not None else None,ttl_seconds)
+
+async def cleanup_metadata_cache():
+    async with db() as conn:
+        await conn.execute('DELETE FROM video_metadata_cache WHERE expires_at<=LOCALTIMESTAMP')
+
+async def get_cached_file(cache_key:str)->Optional[Dict]:
+    async with db() as conn:
+        row=await conn.fetchrow('UPDATE telegram_file_cache SET hits=hits+1 WHERE cache_key=$1 RETURNING file_id,file_size,media_type',cache_key)
+    return dict(row) if row else None
+
+async def store_cached_file(cache_key:str,file_id:str,file_size:Optional[int],media_type:str):
+    async with db() as conn:
+        await conn.execute('''INSERT INTO telegram_file_cache(cache_key,file_id,file_size,media_type) VALUES($1,$2,$3,$4)
+            ON CONFLICT(cache_key) DO UPDATE SET file_id=EXCLUDED.file_id,file_size=EXCLUDED.file_size,media_type=EXCLUDED.media_type''',
+            cache_key,file_id,file_size,media_type)
+
+async def delete_cached_file(cache_key:str):
+    async with db() as conn:
+        await conn.execute('DELETE FROM telegram_file_cache WHERE cache_key=$1',cache_key)
+
+async def enqueue_update(payload:Dict):
+    async with db() as conn:
+        await conn.execute('INSERT INTO update_queue(update_id,payload) VALUES($1,$2)',payload.get('update_id'),json.dumps(payload))
+
+# Забирает до limit апдейтов; SKIP LOCKED позволяет нескольким воркерам и инстансам не мешать друг другу.
+# Аренда короткая и продлевается extend_update_leases, пока апдейт обрабатывается, поэтому
+# истёкшая аренда означает, что прежний обработчик перестал подавать признаки жизни.
+async def claim_updates(limit:int=1)->List[Dict]:
+    token=uuid.uuid4()
+    async with db() as conn:
+        dropped=await conn.fetch('DELETE FROM update_queue WHERE attempts>=$1 AND available_at<=LOCALTIMESTAMP RETURNING update_id',UPDATE_QUEUE_MAX_ATTEMPTS)
+        for r in dropped:
+            logger.error(f"Апдейт {r['update_id']} не обработан за {UPDATE_QUEUE_MAX_ATTEMPTS} попытки и удалён из очереди")
+        rows=await conn.fetch('''
+            WITH picked AS (
+                SELECT id FROM update_queue WHERE available_at<=LOCALTIMESTAMP
+                ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+            )
+            UPDATE update_queue q SET attempts=q.attempts+1,available_at=LOCALTIMESTAMP+make_interval(secs=>$2),lease_token=$3
+            FROM picked WHERE q.id=picked.id
+            RETURNING q.id,q.payload,q.attempts''',limit,UPDATE_QUEUE_LEASE_SECONDS,token)
+    return [{'id':r['id'],'payload':json.loads(r['payload']),'attempts':r['attempts'],'lease_token':token} for r in sorted(rows,key=lambda r:r['id'])]
+
+# Продлевает аренду апдейтов {queue_id: lease_token}; возвращает id, аренда которых ещё за нами
+async def extend_update_leases(leases:Dict[int,uuid.UUID])->set:
+    async with db() as conn:
+        rows=await conn.fetch('''
+            UPDATE update_queue q SET available_at=LOCALTIMESTAMP+make_interval(secs=>$3)
+            FROM unnest($1::bigint[],$2::uuid[]) AS l(id,token)
+            WHERE q.id=l.id AND q.lease_token=l.token
+            RETURNING q.id''',list(leases.keys()),list(leases.values()),UPDATE_QUEUE_LEASE_SECONDS)
+    return {r['id'] for r in rows}
+
+async def complete_update(queue_id:int,lease_token:uuid.UUID):
+    async with db() as conn:
+        await conn.execute('DELETE FROM update_queue WHERE id=$1 AND lease_token=$2',queue_id,lease_token)
+
+# True, если апдейт нужно обработать: update_id встретился впервые или отметку поставила прежняя аренда
+# той же строки очереди. Токен строки меняется только при повторном взятии после истечения аренды,
+# поэтому такая отметка принадлежит держателю, который перестал её продлевать, — она переходит к новой аренде.
+# Повторная доставка от Telegram приходит отдельной строкой очереди и отбрасывается.
+async def mark_update_seen(update_id:int,queue_id:Optional[int]=None,lease_token:Optional[uuid.UUID]=None)->bool:
+    async with db() as conn:
+        row=await conn.fetchrow('''INSERT INTO processed_updates(update_id,queue_id,lease_token) VALUES($1,$2,$3)
+            ON CONFLICT(update_id) DO UPDATE SET lease_token=EXCLUDED.lease_token,seen_at=CURRENT_TIMESTAMP
+            WHERE processed_updates.queue_id=EXCLUDED.queue_id AND processed_updates.lease_token<>EXCLUDED.lease_token
+            RETURNING update_id''',update_id,queue_id,lease_token)
+    return row is not None
+
+async def cleanup_processed_updates():
+    async with db() as conn:
+        await conn.execute('DELETE FROM processed_updates WHERE seen_at<$1',datetime.now()-timedelta(hours=PROCESSED_UPDATES_TTL_HOURS))
+
+# Возвращает (версия, данные); данные None, если версия совпадает с known_version или записи нет
+async def load_user_session(user_id:int,known_version:int=0):
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT version,CASE WHEN version<>$2 THEN data END AS data FROM user_sessions WHERE user_id=$1',user_id,known_version)
+    if not row:
+        return None,None
+    return row['version'],(json.loads(row['data']) if row['data'] is not None else None)
+
+# Пакетная запись: один запрос на все изменённые сессии, возвращает новые версии
+async def save_user_sessions(sessions:Dict[int,str])->Dict[int,int]:
+    async with db() as conn:
+        rows=await conn.fetch('''INSERT INTO user_sessions(user_id,data) SELECT * FROM unnest($1::bigint[],$2::jsonb[])
+            ON CONFLICT(user_id) DO UPDATE SET data=EXCLUDED.data,version=user_sessions.version+1,updated_at=CURRENT_TIMESTAMP
+            RETURNING user_id,version''',list(sessions.keys()),list(sessions.values()))
+    return {r['user_id']:r['version'] for r in rows}
+
+async def delete_user_session(user_id:int):
+    async with db() as conn:
+        await conn.execute('DELETE FROM user_sessions WHERE user_id=$1',user_id)
 
 async def remove_user_feature(user_id:int,feature:str):
-    conn = await db()
-    await conn.execute('DELETE FROM subscriptions WHERE user_id=$1 AND feature=$2',user_id,feature)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('DELETE FROM subscriptions WHERE user_id=$1 AND feature=$2',user_id,feature)
+    invalidate_features(user_id)
 
 async def remove_all_user_features(user_id:int):
-    conn = await db()
-    await conn.execute('DELETE FROM subscriptions WHERE user_id=$1',user_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('DELETE FROM subscriptions WHERE user_id=$1',user_id)
+    invalidate_features(user_id)
 
 async def update_subscription_expiry(user_id:int,feature:str,new_days:int):
-    conn = await db()
-    new_expiry=datetime.now()+timedelta(days=new_days)
-    await conn.execute('UPDATE subscriptions SET expires_at=$1 WHERE user_id=$2 AND feature=$3',new_expiry,user_id,feature)
-    await conn.close()
+    async with db() as conn:
+        new_expiry=datetime.now()+timedelta(days=new_days)
+        await conn.execute('UPDATE subscriptions SET expires_at=$1 WHERE user_id=$2 AND feature=$3',new_expiry,user_id,feature)
+    invalidate_features(user_id)
 
 async def get_user_info(user_id:int)->Optional[Dict]:
-    conn = await db()
-    row=await conn.fetchrow('SELECT username,first_seen,is_blocked FROM users WHERE user_id=$1',user_id)
-    await conn.close()
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT username,first_seen,is_blocked FROM users WHERE user_id=$1',user_id)
     return {'username':row['username'],'first_seen':row['first_seen'],'is_blocked':row['is_blocked']==1} if row else None
 
 async def get_all_users_count()->int:
-    conn=await db()
-    row=await conn.fetchrow('SELECT COUNT(*) AS c FROM users')
-    await conn.close()
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT COUNT(*) AS c FROM users')
     return row['c'] if row else 0
 
 async def get_active_subscriptions_count()->int:
-    conn=await db()
-    row=await conn.fetchrow('SELECT COUNT(DISTINCT user_id) AS c FROM subscriptions WHERE expires_at>NOW()')
-    await conn.close()
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT COUNT(DISTINCT user_id) AS c FROM subscriptions WHERE expires_at>NOW()')
     return row['c'] if row else 0
 
 async def get_all_user_ids()->List[int]:
-    conn=await db()
-    rows=await conn.fetch('SELECT user_id FROM users')
-    await conn.close()
+    async with db() as conn:
+        rows=await conn.fetch('SELECT user_id FROM users')
     return [r['user_id'] for r in rows]
 
 async def create_push_message(message_id:str,text:str,lifetime:int)->bool:
     try:
-        conn=await db()
-        await conn.execute('INSERT INTO push_messages(id,text,lifetime) VALUES($1,$2,$3)',message_id,text,lifetime)
-        await conn.close()
+        async with db() as conn:
+            await conn.execute('INSERT INTO push_messages(id,text,lifetime) VALUES($1,$2,$3)',message_id,text,lifetime)
         return True
     except:
         return False
 
 async def save_push_recipient(push_id:str,user_id:int,message_id:int):
-    conn=await db()
-    await conn.execute('INSERT INTO push_recipients(push_id,user_id,message_id) VALUES($1,$2,$3)',push_id,user_id,message_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('INSERT INTO push_recipients(push_id,user_id,message_id) VALUES($1,$2,$3)',push_id,user_id,message_id)
 
 async def get_push_recipients(push_id:str)->List[Dict]:
-    conn=await db()
-    rows=await conn.fetch('SELECT user_id,message_id FROM push_recipients WHERE push_id=$1',push_id)
-    await conn.close()
+    async with db() as conn:
+        rows=await conn.fetch('SELECT user_id,message_id FROM push_recipients WHERE push_id=$1',push_id)
     return [{'user_id':r['user_id'],'message_id':r['message_id']} for r in rows]
 
 async def delete_push_message(message_id:str)->bool:
-    conn=await db()
-    await conn.execute('UPDATE push_messages SET active=0 WHERE id=$1',message_id)
-    await conn.execute('DELETE FROM push_recipients WHERE push_id=$1',message_id)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('UPDATE push_messages SET active=0 WHERE id=$1',message_id)
+        await conn.execute('DELETE FROM push_recipients WHERE push_id=$1',message_id)
     return True
 
 async def get_push_message(message_id:str)->Optional[Dict]:
-    conn=await db()
-    row=await conn.fetchrow('SELECT id,text,lifetime,created_at FROM push_messages WHERE id=$1 AND active=1',message_id)
-    await conn.close()
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT id,text,lifetime,created_at FROM push_messages WHERE id=$1 AND active=1',message_id)
     return dict(row) if row else None
 
 async def get_active_push_messages()->List[Dict]:
-    conn=await db()
-    rows=await conn.fetch('SELECT id,text,lifetime,created_at FROM push_messages WHERE active=1')
-    await conn.close()
+    async with db() as conn:
+        rows=await conn.fetch('SELECT id,text,lifetime,created_at FROM push_messages WHERE active=1')
     return [dict(r) for r in rows]
 
 async def add_sponsor(link:str)->int:
-    conn=await db()
-    row=await conn.fetchrow('SELECT MAX(position) AS m FROM sponsors WHERE active=1')
-    next_pos=(row['m']+1) if row and row['m'] else 1
-    new_row=await conn.fetchrow('INSERT INTO sponsors(link,position) VALUES($1,$2) RETURNING id',link,next_pos)
-    await conn.close()
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT MAX(position) AS m FROM sponsors WHERE active=1')
+        next_pos=(row['m']+1) if row and row['m'] else 1
+        new_row=await conn.fetchrow('INSERT INTO sponsors(link,position) VALUES($1,$2) RETURNING id',link,next_pos)
     return new_row['id']
 
 async def get_active_sponsors()->List[Dict]:
-    conn=await db()
-    rows=await conn.fetch('SELECT id,link,position FROM sponsors WHERE active=1 ORDER BY position')
-    await conn.close()
+    async with db() as conn:
+        rows=await conn.fetch('SELECT id,link,position FROM sponsors WHERE active=1 ORDER BY position')
     return [dict(r) for r in rows]
 
 async def delete_sponsor(sponsor_id:int)->bool:
-    conn=await db()
-    await conn.execute('UPDATE sponsors SET active=0 WHERE id=$1',sponsor_id)
-    sponsors=await conn.fetch('SELECT id FROM sponsors WHERE active=1 ORDER BY position')
-    for idx,s in enumerate(sponsors,1):
-        await conn.execute('UPDATE sponsors SET position=$1 WHERE id=$2',idx,s['id'])
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('UPDATE sponsors SET active=0 WHERE id=$1',sponsor_id)
+        sponsors=await conn.fetch('SELECT id FROM sponsors WHERE active=1 ORDER BY position')
+        for idx,s in enumerate(sponsors,1):
+            await conn.execute('UPDATE sponsors SET position=$1 WHERE id=$2',idx,s['id'])
     return True
 
 async def delete_all_sponsors()->bool:
-    conn=await db()
-    await conn.execute('UPDATE sponsors SET active=0')
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('UPDATE sponsors SET active=0')
     return True
 
 async def store_user_subscription_check(user_id:int,checked_sponsors:str):
-    conn=await db()
-    await conn.execute('INSERT INTO sponsor_checks(user_id,checked_sponsors_ids,checked_at) VALUES($1,$2,NOW()) ON CONFLICT(user_id) DO UPDATE SET checked_sponsors_ids=EXCLUDED.checked_sponsors_ids,checked_at=NOW()',user_id,checked_sponsors)
-    await conn.close()
+    async with db() as conn:
+        await conn.execute('INSERT INTO sponsor_checks(user_id,checked_sponsors_ids,checked_at) VALUES($1,$2,NOW()) ON CONFLICT(user_id) DO UPDATE SET checked_sponsors_ids=EXCLUDED.checked_sponsors_ids,checked_at=NOW()',user_id,checked_sponsors)
 
 async def check_user_subscribed_sponsors(user_id:int)->Optional[str]:
-    conn=await db()
-    row=await conn.fetchrow('SELECT checked_sponsors_ids FROM sponsor_checks WHERE user_id=$1',user_id)
-    await conn.close()
+    async with db() as conn:
+        row=await conn.fetchrow('SELECT checked_sponsors_ids FROM sponsor_checks WHERE user_id=$1',user_id)
     return row['checked_sponsors_ids'] if row else None
+
+# Всё, что нужно для обработки ссылки, одним запросом вместо 6-7 отдельных
+async def get_user_gate(user_id:int)->Dict:
+    epoch=_features_epoch
+    async with db() as conn:
+        row=await conn.fetchrow(f'''
+            WITH u AS (
+                SELECT is_blocked FROM users WHERE user_id=$1
+            ), f AS (
+                SELECT feature, MIN(expires_at) AS expires_at FROM subscriptions WHERE user_id=$1 AND expires_at>NOW() GROUP BY feature
+            ), d AS (
+                SELECT COALESCE(SUM(downloads),0) + ({RESERVED_SLOTS_SQL}) AS c,
+                       {QUOTA_NEXT_SLOT_SQL} AS next_slot_in
+                FROM download_quota WHERE user_id=$1 AND {QUOTA_WINDOW_SQL}
+            ), s AS (
+                SELECT json_agg(json_build_object('id',id,'link',link,'position',position) ORDER BY position) AS sponsors,
+                       string_agg(id::text,'_' ORDER BY position) AS fingerprint
+                FROM sponsors WHERE active=1
+            )
+            SELECT COALESCE((SELECT is_blocked FROM u),0) AS is_blocked,
+                   ARRAY(SELECT feature FROM f) AS features,
+                   (SELECT MIN(expires_at) FROM f) AS features_expire_at,
+                   (SELECT c FROM d) AS download_count,
+                   (SELECT next_slot_in FROM d) AS next_slot_in,
+                   s.sponsors,
+                   s.fingerprint,
+                   (SELECT checked_sponsors_ids FROM sponsor_checks WHERE user_id=$1) AS checked_sponsors
+            FROM s
+        ''',user_id)
+    sponsors=json.loads(row['sponsors']) if row['sponsors'] else []
+    _cache_features(user_id,row['features'],row['features_expire_at'],epoch)
+    return {
+        'is_blocked':row['is_blocked']==1,
+        'features':set(row['features']),
+        'download_count':row['download_count'],
+        'next_slot_in':row['next_slot_in'],
+        'sponsors':sponsors,
+        'sponsors_fingerprint':row['fingerprint'],
+        'sponsors_ok':not sponsors or row['checked_sponsors']==row['fingerprint'],
+    }
@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import socket
+import shutil
+import asyncio
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional
+from config import DOWNLOAD_DIR, DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS, DOWNLOAD_CACHE_STALE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Кэш скачанных файлов на диске: запись адресуется хэшем ключа доставки (URL + качество),
+# вытесняется по LRU при превышении бюджета и никогда не удаляется, пока файл кто-то отправляет.
+# Каталог downloads/ может быть общим для нескольких процессов: у каждого процесса свой индекс
+# (index-<host>-<pid>.json) и свой каталог временных файлов, бюджет считается на процесс.
+# Чужие файлы процесс не трогает, пока их владелец жив; индекс умершего владельца забирает себе.
+CACHE_DIR = os.path.join(DOWNLOAD_DIR, 'cache')
+TEMP_ROOT = os.path.join(DOWNLOAD_DIR, 'tmp')
+INDEX_SAVE_DELAY = 1.0
+
+# key -> {'path', 'size', 'last_access', 'refs'}; порядок — от давно использованных к свежим
+_entries: "OrderedDict[str, Dict]" = OrderedDict()
+_paths: Dict[str, str] = {}
+# записи, убранные из индекса, пока их файл ещё отправляется: path -> refs
+_orphans: Dict[str, int] = {}
+_total_bytes = 0
+_loaded = False
+_owner = ''
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+# отложенная запись индекса в потоке: задача записи и признак новых изменений
+_save_task: Optional[asyncio.Task] = None
+_dirty = False
+
+def _entry_dir(key: str) -> str:
+    prefix = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return tempfile.mkdtemp(prefix=f"{prefix}-", dir=CACHE_DIR)
+
+def _remove_path(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Не удалось удалить файл {path}: {e}")
+    parent = os.path.dirname(path)
+    if os.path.dirname(parent) == CACHE_DIR:
+        shutil.rmtree(parent, ignore_errors=True)
+
+def _index_file(owner: str) -> str:
+    return os.path.join(CACHE_DIR, f"index-{owner}.json")
+
+def _temp_dir_of(owner: str) -> str:
+    return os.path.join(TEMP_ROOT, owner)
+
+# Время запуска процесса по /proc (Linux); None, если процесса нет или /proc недоступен
+def _process_started_at(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+    return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+
+# Владелец жив, если это процесс на этом же хосте, запущенный раньше, чем был записан его файл
+# (иначе pid уже занят другим процессом). Про другие хосты судим только по возрасту файла.
+def _owner_alive(owner: str, written_at: float) -> bool:
+    host, _, pid = owner.rpartition('-')
+    if host != socket.gethostname() or not pid.isdigit():
+        return time.time() - written_at < DOWNLOAD_CACHE_STALE_SECONDS
+    started_at = _process_started_at(int(pid))
+    if started_at is not None:
+        return started_at <= written_at + 1
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _read_index(path: str) -> Dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_index(path: str, data: Dict):
+    temp_file = f"{path}.tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_file, path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить индекс кэша файлов: {e}")
+
+def _snapshot() -> Dict:
+    return {
+        key: {'path': entry['path'], 'size': entry['size'], 'last_access': entry['last_access']}
+        for key, entry in _entries.items()
+    }
+
+# Индекс переписывается не чаще раза в INDEX_SAVE_DELAY и в отдельном потоке, чтобы не блокировать event loop
+def _save_index():
+    global _dirty, _save_task
+    _dirty = True
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _dirty = False
+        _write_index(_index_file(_owner), _snapshot())
+        return
+    if _save_task is None or _save_task.done():
+        _save_task = loop.create_task(_save_index_later())
+
+async def _save_index_later():
+    global _dirty
+    while _dirty:
+        await asyncio.sleep(INDEX_SAVE_DELAY)
+        _dirty = False
+        await asyncio.to_thread(_write_index, _index_file(_owner), _snapshot())
+
+# Записывает индекс сразу — при остановке процесса
+async def flush_index():
+    global _dirty
+    if not _loaded:
+        return
+    _dirty = False
+    await asyncio.to_thread(_write_index, _index_file(_owner), _snapshot())
+
+# Индекс читается при первом обращении. Процесс забирает индексы умерших владельцев, удаляет их
+# временные каталоги и каталоги записей, которых нет ни в одном индексе и которые старше
+# DOWNLOAD_CACHE_STALE_SECONDS (моложе — возможно, живой процесс ещё не записал индекс)
+def _load():
+    global _loaded, _total_bytes, _owner
+    if _loaded:
+        return
+    _loaded = True
+    _owner = f"{socket.gethostname()}-{os.getpid()}"
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    os.makedirs(TEMP_ROOT, exist_ok=True)
+    now = time.time()
+
+    for name in os.listdir(TEMP_ROOT):
+        temp_dir_path = _temp_dir_of(name)
+        try:
+            written_at = os.stat(temp_dir_path).st_ctime
+        except OSError:
+            continue
+        if name == _owner or not _owner_alive(name, written_at):
+            shutil.rmtree(temp_dir_path, ignore_errors=True)
+    os.makedirs(_temp_dir_of(_owner), exist_ok=True)
+
+    data = {}
+    referenced = set()
+    for name in os.listdir(CACHE_DIR):
+        if not (name.startswith('index-') and name.endswith('.json')):
+            continue
+        owner = name[len('index-'):-len('.json')]
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            written_at = os.stat(path).st_ctime
+        except OSError:
+            continue
+        index = _read_index(path)
+        if owner != _owner and _owner_alive(owner, written_at):
+            referenced.update(os.path.dirname(entry.get('path', '')) for entry in index.values())
+            continue
+        for key, entry in index.items():
+            if key not in data or entry.get('last_access', 0) > data[key].get('last_access', 0):
+                data[key] = entry
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    for key, entry in sorted(data.items(), key=lambda item: item[1].get('last_access', 0)):
+        path = entry.get('path')
+        if not path or not os.path.isfile(path) or os.path.dirname(path) in referenced:
+            continue
+        size = os.path.getsize(path)
+        if key in _entries:
+            _forget_loaded(key)
+        _entries[key] = {'path': path, 'size': size, 'last_access': entry.get('last_access', 0), 'refs': 0}
+        _paths[path] = key
+        _total_bytes += size
+
+    referenced.update(os.path.dirname(path) for path in _paths)
+    for name in os.listdir(CACHE_DIR):
+        entry_dir = os.path.join(CACHE_DIR, name)
+        if not os.path.isdir(entry_dir) or entry_dir in referenced:
+            continue
+        try:
+            if now - os.stat(entry_dir).st_mtime > DOWNLOAD_CACHE_STALE_SECONDS:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        except OSError:
+            pass
+
+    _evict()
+    _write_index(_index_file(_owner), _snapshot())
+    logger.info(f"Кэш файлов: {len(_entries)} записей, {_total_bytes / (1024 * 1024):.1f} MB")
+
+def _forget_loaded(key: str):
+    global _total_bytes
+    entry = _entries.pop(key)
+    _paths.pop(entry['path'], None)
+    _total_bytes -= entry['size']
+    _remove_path(entry['path'])
+
+def _evict() -> bool:
+    global _total_bytes
+    evicted = False
+    for key in list(_entries):
+        if _total_bytes <= DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS:
+            break
+        entry = _entries[key]
+        if entry['refs'] > 0:
+            continue
+        del _entries[key]
+        _paths.pop(entry['path'], None)
+        _total_bytes -= entry['size']
+        _remove_path(entry['path'])
+        _stats['evictions'] += 1
+        evicted = True
+        logger.info(f"Кэш файлов: вытеснен {entry['path']} ({entry['size'] / (1024 * 1024):.1f} MB)")
+    return evicted
+
+# Возвращает путь к закэшированному файлу и увеличивает счётчик ссылок; вызывающий обязан вызвать release()
+def acquire(key: str) -> Optional[str]:
+    _load()
+    entry = _entries.get(key)
+    if entry is None or not os.path.isfile(entry['path']):
+        if entry is not None:
+            forget(key)
+        _stats['misses'] += 1
+        return None
+    entry['refs'] += 1
+    entry['last_access'] = time.time()
+    _entries.move_to_end(key)
+    _stats['hits'] += 1
+    return entry['path']
+
+# Отдельный временный каталог на каждое скачивание: файлы разных задач не пересекаются
+def temp_dir() -> str:
+    _load()
+    return tempfile.mkdtemp(dir=_temp_dir_of(_owner))
+
+# Атомарно переносит готовый файл в кэш (rename в пределах одной ФС) и выдаёт одну ссылку на него
+def store(key: str, filename: str) -> str:
+    global _total_bytes
+    _load()
+    # тот же файл уже успели положить в кэш — новую копию не храним
+    existing = _entries.get(key)
+    if existing and os.path.isfile(existing['path']):
+        existing['refs'] += 1
+        existing['last_access'] = time.time()
+        _entries.move_to_end(key)
+        _remove_path(filename)
+        return existing['path']
+    forget(key)
+
+    entry_dir = _entry_dir(key)
+    path = os.path.join(entry_dir, os.path.basename(filename))
+    os.replace(filename, path)
+
+    size = os.path.getsize(path)
+    _entries[key] = {'path': path, 'size': size, 'last_access': time.time(), 'refs': 1}
+    _paths[path] = key
+    _total_bytes += size
+    _stats['stores'] += 1
+
+    _evict()
+    _save_index()
+    return path
+
+# Добавляет ссылки на уже выданный файл — для тех, кто дождался общего скачивания
+def retain(path: str, count: int = 1):
+    if count <= 0:
+        return
+    key = _paths.get(path)
+    if key is None:
+        _orphans[path] = _orphans.get(path, 1) + count
+        return
+    _entries[key]['refs'] += count
+
+# Освобождает ссылку, полученную из acquire() или store(); файлы вне кэша просто удаляются
+def release(path: str):
+    key = _paths.get(path)
+    if key is None:
+        refs = _orphans.pop(path, 1) - 1
+        if refs > 0:
+            _orphans[path] = refs
+        else:
+            _remove_path(path)
+        return
+    entry = _entries[key]
+    entry['refs'] = max(entry['refs'] - 1, 0)
+    if entry['refs'] == 0 and _evict():
+        _save_index()
+
+# Убирает запись из кэша; файл удаляется сразу или после освобождения последней ссылки
+def forget(key: str):
+    global _total_bytes
+    entry = _entries.pop(key, None)
+    if entry is None:
+        return
+    _total_bytes -= entry['size']
+    _paths.pop(entry['path'], None)
+    if entry['refs'] > 0:
+        _orphans[entry['path']] = entry['refs']
+    else:
+        _remove_path(entry['path'])
+    _save_index()
+
+def get_stats() -> Dict:
+    lookups = _stats['hits'] + _stats['misses']
+    return {
+        **_stats,
+        'entries': len(_entries),
+        'bytes': _total_bytes,
+        'max_bytes_per_process': DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS,
+        'in_use': sum(1 for entry in _entries.values() if entry['refs'] > 0),
+        'hit_rate': _stats['hits'] / lookups if lookups else 0.0,
+    }
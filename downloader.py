@@ -1,85 +1,329 @@
-import yt_dlp
 import re
 from typing import Optional, Dict, List
 import os
+import shutil
 import logging
 import asyncio
+import time
 import httpx
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import database as db
+from ttl_cache import TTLCache
+import disk_cache
+import ytdlp_worker
+from config import (
+    METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_SHORT_TTL, TIKWM_URL_TTL,
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_PER_HOST_LIMIT, HTTP_KEEPALIVE_EXPIRY,
+    DOWNLOAD_CHUNK_SIZE,
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Кэш метаданных: LRU в памяти перед таблицей в Postgres, которая переживает рестарты.
+# Отрицательные результаты и изображения Pinterest кэшируются ненадолго — это часто временный сбой yt-dlp,
+# а явные временные сбои (MetadataLookupFailed) не кэшируются вовсе.
+_metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+_metadata_db_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+# Временный сбой получения метаданных (сеть, таймаут, ответ не 200, лимит запросов TikWM).
+# В отличие от None («ссылка недоступна») такой результат не кэшируется.
+class MetadataLookupFailed(Exception):
+    pass
+
+# Ответы TikWM (ссылки play/hdplay/music) живут до истечения CDN-ссылок,
+# чтобы скачивание после превью шло сразу на CDN без повторного запроса к API.
+TIKWM_URL_MARGIN = 60
+
+_tiktok_resolutions = TTLCache(METADATA_CACHE_SIZE, TIKWM_URL_TTL)
+
+# Общий HTTP-клиент для всего загрузчика: keep-alive, HTTP/2, лимит соединений на хост
+# и отдельные таймауты для запросов к API и для передачи файлов.
+API_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+TRANSFER_TIMEOUT = httpx.Timeout(connect=10.0, read=120.0, write=600.0, pool=60.0)
+
+_http_client: Optional[httpx.AsyncClient] = None
+_host_limits: Dict[str, asyncio.Semaphore] = {}
+_host_stats: Dict[str, Dict[str, int]] = {}
+
+def _create_http_client() -> httpx.AsyncClient:
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        logger.warning("Пакет h2 не установлен, HTTP/2 отключён")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    # стандартный транспорт httpx: адреса перебираются при подключении, прокси из окружения учитываются
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=limits,
+        timeout=API_TIMEOUT,
+        follow_redirects=True,
+    )
+
+async def init_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_http_client()
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        client, _http_client = _http_client, None
+        await client.aclose()
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_http_client()
+    return _http_client
+
+@asynccontextmanager
+async def _host_slot(url: str):
+    # ограничивает число одновременных запросов к хосту и считает переиспользование соединений
+    host = httpx.URL(url).host
+    limit = _host_limits.setdefault(host, asyncio.Semaphore(HTTP_PER_HOST_LIMIT))
+    stats = _host_stats.setdefault(host, {'requests': 0, 'new_connections': 0})
+    
+    async def trace(event_name: str, info: Dict):
+        if event_name == 'connection.connect_tcp.complete':
+            stats['new_connections'] += 1
+    
+    async with limit:
+        stats['requests'] += 1
+        yield {'trace': trace}
+
+async def http_request(method: str, url: str, *, timeout: httpx.Timeout = API_TIMEOUT, **kwargs) -> httpx.Response:
+    async with _host_slot(url) as extensions:
+        return await get_http_client().request(method, url, timeout=timeout, extensions=extensions, **kwargs)
+
+# Потоковое скачивание: в памяти держим не больше DOWNLOAD_WRITE_BUFFER, а не весь файл.
+# Запись и fsync идут в потоке — на большом файле они блокировали бы event loop на секунды
+DOWNLOAD_WRITE_BUFFER = 1024 * 1024
+
+def _sync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+async def stream_to_file(url: str, filename: str) -> Optional[Dict]:
+    temp_filename = f"{filename}.part"
+    started = time.monotonic()
+    size = 0
+    try:
+        async with _host_slot(url) as extensions:
+            async with get_http_client().stream('GET', url, timeout=TRANSFER_TIMEOUT, extensions=extensions) as response:
+                if response.status_code != 200:
+                    logger.error(f"Не удалось скачать файл: {response.status_code}")
+                    return None
+                f = await asyncio.to_thread(open, temp_filename, 'wb')
+                try:
+                    buffer = bytearray()
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        buffer += chunk
+                        size += len(chunk)
+                        if len(buffer) >= DOWNLOAD_WRITE_BUFFER:
+                            await asyncio.to_thread(f.write, bytes(buffer))
+                            buffer.clear()
+                    if buffer:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                    await asyncio.to_thread(_sync_file, f)
+                finally:
+                    f.close()
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+    
+    elapsed = max(time.monotonic() - started, 1e-6)
+    stats = {'bytes': size, 'seconds': elapsed, 'mb_per_s': size / (1024 * 1024) / elapsed}
+    logger.info(f"✅ Успешно скачано: {filename} ({size / (1024 * 1024):.2f} MB за {elapsed:.1f} с, {stats['mb_per_s']:.2f} MB/s)")
+    return stats
+
+def get_http_stats() -> Dict:
+    return {
+        host: {
+            **stats,
+            'reuse_rate': 1 - stats['new_connections'] / stats['requests'] if stats['requests'] else 0.0,
+        }
+        for host, stats in _host_stats.items()
+    }
+
+def canonical_url(url: str) -> str:
+    tiktok_id = re.search(r'tiktok\.com/.*?/video/(\d+)', url)
+    if tiktok_id:
+        return f"tiktok:{tiktok_id.group(1)}"
+    pin_id = re.search(r'pinterest\.[a-z.]+/pin/(\d+)', url)
+    if pin_id:
+        return f"pinterest:{pin_id.group(1)}"
+    # короткие ссылки (vm.tiktok.com, pin.it) — без схемы, www, параметров и якоря
+    parts = urlsplit(url if '://' in url else f"https://{url}")
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return f"{host}{parts.path.rstrip('/')}"
+
+def delivery_key(url: str, quality: Optional[str], audio_only: bool) -> str:
+    return f"{canonical_url(url)}|{'audio' if audio_only else (quality or 'best')}"
+
+def get_metadata_cache_stats() -> Dict:
+    lookups = _metadata_db_stats['hits'] + _metadata_db_stats['misses']
+    return {
+        'memory': _metadata_cache.stats(),
+        'postgres': {**_metadata_db_stats, 'hit_rate': _metadata_db_stats['hits'] / lookups if lookups else 0.0},
+    }
+
 async def upload_to_fileio(filepath: str) -> Optional[str]:
     try:
         logger.info(f"Загрузка файла на file.io: {filepath}")
         
-        async with httpx.AsyncClient(timeout=600.0) as client:
-            with open(filepath, 'rb') as f:
-                files = {'file': f}
-                response = await client.post('https://file.io', files=files)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('success'):
-                        link = data.get('link')
-                        logger.info(f"Файл успешно загружен: {link}")
-                        return link
-                else:
-                    logger.error(f"Ошибка загрузки на file.io: {response.status_code}")
-                    return None
+        with open(filepath, 'rb') as f:
+            files = {'file': f}
+            response = await http_request('POST', 'https://file.io', files=files, timeout=TRANSFER_TIMEOUT)
+            
+            if response.status_code == 200:
+                data = response.json()
+                if data.get('success'):
+                    link = data.get('link')
+                    logger.info(f"Файл успешно загружен: {link}")
+                    return link
+            else:
+                logger.error(f"Ошибка загрузки на file.io: {response.status_code}")
+                return None
     except Exception as e:
         logger.error(f"Ошибка при загрузке на file.io: {str(e)}", exc_info=True)
         return None
 
+# None — TikWM не нашёл видео по ссылке; сбои сети и ответы не 200 пробрасываются исключением,
+# ответ об ограничении частоты запросов (1 запрос/с) — MetadataLookupFailed
+async def _fetch_tikwm(url: str) -> Optional[Dict]:
+    response = await http_request(
+        'GET',
+        'https://www.tikwm.com/api/',
+        params={'url': url, 'hd': 1}
+    )
+    
+    if response.status_code != 200:
+        raise MetadataLookupFailed(f"Ошибка TikWM API: {response.status_code}")
+    
+    data = response.json()
+    
+    if data.get('code') != 0:
+        message = str(data.get('msg') or '')
+        if 'limit' in message.lower():
+            raise MetadataLookupFailed(f"TikWM API ограничил частоту запросов: {message}")
+        logger.error(f"TikWM API вернул код ошибки: {data.get('code')} {message}")
+        return None
+    
+    video_data = data.get('data', {})
+    _remember_tiktok_resolution(url, video_data)
+    return video_data
+
+def _tiktok_urls_expire_at(video_data: Dict) -> float:
+    # CDN-ссылки TikTok содержат срок жизни в параметре x-expires/expire; без него считаем TIKWM_URL_TTL
+    expires = [time.time() + TIKWM_URL_TTL]
+    for key in ('play', 'hdplay', 'music'):
+        match = re.search(r'[?&](?:x-expires|expire)=(\d+)', video_data.get(key) or '')
+        if match:
+            expires.append(float(match.group(1)))
+    return min(expires)
+
+def _remember_tiktok_resolution(url: str, video_data: Dict):
+    expires_at = _tiktok_urls_expire_at(video_data)
+    _tiktok_resolutions.set(canonical_url(url), video_data, expires_at - time.time() - TIKWM_URL_MARGIN)
+
+def _get_tiktok_resolution(url: str) -> Optional[Dict]:
+    key = canonical_url(url)
+    video_data = _tiktok_resolutions.get(key)
+    if video_data:
+        return video_data
+    # после рестарта или вытеснения ссылки могут остаться в закэшированных метаданных превью;
+    # peek не искажает статистику попаданий кэша метаданных
+    info = _metadata_cache.peek(key)
+    if info and info.get('api_data') and info.get('api_expires_at', 0) - TIKWM_URL_MARGIN > time.time():
+        return info['api_data']
+    return None
+
 async def extract_tiktok_info_api(url: str) -> Optional[Dict]:
     try:
         logger.info(f"Извлечение информации TikTok через API: {url}")
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                'https://www.tikwm.com/api/',
-                params={'url': url, 'hd': 1}
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка TikWM API: {response.status_code}")
-                return None
-            
-            data = response.json()
-            
-            if data.get('code') != 0:
-                logger.error(f"TikWM API вернул код ошибки: {data.get('code')}")
-                return None
-            
-            video_data = data.get('data', {})
-            
-            title = video_data.get('title', 'TikTok Video')
-            duration = video_data.get('duration', 0)
-            thumbnail = video_data.get('cover', '')
-            
-            formats_list = []
-            if video_data.get('hdplay'):
-                formats_list.append({'quality': 'HD', 'format_id': 'hd', 'height': 1080})
-            if video_data.get('play'):
-                formats_list.append({'quality': 'SD', 'format_id': 'sd', 'height': 720})
-            
-            logger.info(f"✅ TikTok информация извлечена: {title}")
-            
-            return {
-                'title': title,
-                'duration': duration,
-                'thumbnail': thumbnail,
-                'platform': 'tiktok',
-                'formats': formats_list,
-                'url': url,
-                'api_data': video_data,
-                'is_image': False
-            }
+        video_data = await _fetch_tikwm(url)
+        if video_data is None:
+            return None
+        
+        title = video_data.get('title', 'TikTok Video')
+        duration = video_data.get('duration', 0)
+        thumbnail = video_data.get('cover', '')
+        
+        formats_list = []
+        if video_data.get('hdplay'):
+            formats_list.append({'quality': 'HD', 'format_id': 'hd', 'height': 1080})
+        if video_data.get('play'):
+            formats_list.append({'quality': 'SD', 'format_id': 'sd', 'height': 720})
+        
+        logger.info(f"✅ TikTok информация извлечена: {title}")
+        
+        return {
+            'title': title,
+            'duration': duration,
+            'thumbnail': thumbnail,
+            'platform': 'tiktok',
+            'formats': formats_list,
+            'url': url,
+            'api_data': video_data,
+            'api_expires_at': _tiktok_urls_expire_at(video_data),
+            'is_image': False
+        }
+    except MetadataLookupFailed:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка извлечения TikTok информации: {str(e)}", exc_info=True)
-        return None
+        raise MetadataLookupFailed(str(e)) from e
 
 async def extract_video_info_async(url: str) -> Optional[Dict]:
+    key = canonical_url(url)
+    
+    cached = _metadata_cache.get(key)
+    if cached is not None:
+        return cached or None
+    
+    try:
+        found, info, ttl = await db.get_cached_metadata(key)
+    except Exception as e:
+        logger.warning(f"Кэш метаданных в БД недоступен: {e}")
+        _metadata_db_stats['errors'] += 1
+        found, info, ttl = False, None, 0
+    
+    if found:
+        _metadata_db_stats['hits'] += 1
+        _metadata_cache.set(key, info or False, ttl)
+        return info
+    _metadata_db_stats['misses'] += 1
+    
+    try:
+        info = await _extract_video_info(url)
+    except MetadataLookupFailed as e:
+        # временный сбой не кэшируем ни в памяти, ни в БД — повторный запрос пойдёт к источнику
+        logger.warning(f"Метаданные {key} временно недоступны: {e}")
+        return None
+    
+    ttl = METADATA_CACHE_TTL if info and not info.get('is_image') else METADATA_SHORT_TTL
+    _metadata_cache.set(key, info or False, ttl)
+    try:
+        await db.store_cached_metadata(key, info, ttl)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить метаданные в кэш БД: {e}")
+        _metadata_db_stats['errors'] += 1
+    
+    return info
+
+async def _extract_video_info(url: str) -> Optional[Dict]:
     platform = 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok'
     
     if platform == 'tiktok':
@@ -103,16 +347,7 @@ async def extract_video_info_async(url: str) -> Optional[Dict]:
         
         logger.info(f"Извлечение информации Pinterest: {url}")
         
-        def extract_sync():
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(url, download=False)
-            except Exception as e:
-                logger.error(f"Ошибка yt-dlp: {e}")
-                return None
-        
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(None, extract_sync)
+        info = await ytdlp_worker.run(ytdlp_worker.extract_info, url, 'info', ydl_opts, timeout=ytdlp_worker.YTDLP_INFO_TIMEOUT)
         
         if not info:
             logger.error("yt-dlp вернул None - возможно это изображение, а не видео")
@@ -177,7 +412,7 @@ async def extract_video_info_async(url: str) -> Optional[Dict]:
         }
     except Exception as e:
         logger.error(f"❌ Ошибка извлечения из {url}: {str(e)}", exc_info=True)
-        return None
+        raise MetadataLookupFailed(str(e)) from e
 
 def is_valid_url(url: str) -> bool:
     pinterest_pattern = r'(https?://)?(www\.)?(pinterest\.com|pin\.it)/.+'
@@ -190,79 +425,81 @@ def extract_urls(text: str) -> List[str]:
     urls = re.findall(url_pattern, text)
     return [url for url in urls if is_valid_url(url)]
 
+async def _download_tiktok_file(url: str, video_data: Dict, quality: Optional[str], audio_only: bool, target_dir: str) -> Optional[str]:
+    if audio_only:
+        download_url = video_data.get('music')
+        if not download_url:
+            logger.error("URL аудио не найден в ответе API")
+            return None
+        file_ext = 'mp3'
+    else:
+        if quality == 'sd':
+            download_url = video_data.get('play')
+            logger.info("Используется SD качество")
+        elif quality == 'hd' or quality is None:
+            download_url = video_data.get('hdplay') or video_data.get('play')
+            logger.info(f"Используется HD качество (доступно: {bool(video_data.get('hdplay'))})")
+        else:
+            download_url = video_data.get('hdplay') or video_data.get('play')
+        
+        if not download_url:
+            logger.error("URL видео не найден в ответе API")
+            return None
+        file_ext = 'mp4'
+    
+    video_id = re.search(r'/video/(\d+)', url)
+    if video_id:
+        filename = os.path.join(target_dir, f"{video_id.group(1)}.{file_ext}")
+    else:
+        import hashlib
+        filename = os.path.join(target_dir, f"{hashlib.md5(url.encode()).hexdigest()}.{file_ext}")
+    
+    logger.info(f"Скачивание с: {download_url[:100]}...")
+    
+    if not await stream_to_file(download_url, filename):
+        return None
+    
+    return filename
+
 async def download_tiktok_via_api(url: str, quality: Optional[str] = None, audio_only: bool = False) -> Optional[str]:
+    key = delivery_key(url, quality, audio_only)
+    cached = disk_cache.acquire(key)
+    if cached:
+        logger.info(f"Файл взят из кэша на диске: {cached}")
+        return cached
+    
+    job_dir = disk_cache.temp_dir()
     try:
         logger.info(f"Скачивание TikTok через API: {url}, quality={quality}, audio_only={audio_only}")
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.get(
-                'https://www.tikwm.com/api/',
-                params={'url': url, 'hd': 1}
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка TikWM API: {response.status_code}")
-                return None
-            
-            data = response.json()
-            
-            if data.get('code') != 0:
-                logger.error(f"TikWM API вернул код ошибки: {data.get('code')}")
-                return None
-            
-            video_data = data.get('data', {})
-            
-            if audio_only:
-                download_url = video_data.get('music')
-                if not download_url:
-                    logger.error("URL аудио не найден в ответе API")
-                    return None
-                file_ext = 'mp3'
-            else:
-                if quality == 'sd':
-                    download_url = video_data.get('play')
-                    logger.info("Используется SD качество")
-                elif quality == 'hd' or quality is None:
-                    download_url = video_data.get('hdplay') or video_data.get('play')
-                    logger.info(f"Используется HD качество (доступно: {bool(video_data.get('hdplay'))})")
-                else:
-                    download_url = video_data.get('hdplay') or video_data.get('play')
-                
-                if not download_url:
-                    logger.error("URL видео не найден в ответе API")
-                    return None
-                file_ext = 'mp4'
-            
-            os.makedirs('downloads', exist_ok=True)
-            
-            video_id = re.search(r'/video/(\d+)', url)
-            if video_id:
-                filename = f"downloads/{video_id.group(1)}.{file_ext}"
-            else:
-                import hashlib
-                filename = f"downloads/{hashlib.md5(url.encode()).hexdigest()}.{file_ext}"
-            
-            logger.info(f"Скачивание с: {download_url[:100]}...")
-            
-            video_response = await client.get(download_url)
-            
-            if video_response.status_code != 200:
-                logger.error(f"Не удалось скачать файл: {video_response.status_code}")
+        # Ссылки на CDN, полученные при построении превью, используем без повторного запроса к TikWM
+        filename = None
+        video_data = _get_tiktok_resolution(url)
+        if video_data:
+            try:
+                filename = await _download_tiktok_file(url, video_data, quality, audio_only, job_dir)
+            except httpx.HTTPError as e:
+                # обрыв соединения или таймаут по старой ссылке — то же, что и ответ не 200
+                logger.warning(f"Ошибка при скачивании по сохранённой ссылке TikTok: {e}")
+            if not filename:
+                logger.info("Сохранённая ссылка TikTok недоступна, повторный запрос к TikWM API")
+                _tiktok_resolutions.pop(canonical_url(url))
+        
+        if not filename:
+            video_data = await _fetch_tikwm(url)
+            if video_data is None:
                 return None
-            
-            with open(filename, 'wb') as f:
-                f.write(video_response.content)
-            
-            file_size = os.path.getsize(filename) / (1024 * 1024)
-            logger.info(f"✅ Успешно скачано: {filename} ({file_size:.2f} MB)")
-            
-            return filename
-            
+            filename = await _download_tiktok_file(url, video_data, quality, audio_only, job_dir)
+        
+        return disk_cache.store(key, filename) if filename else None
+        
     except Exception as e:
         logger.error(f"❌ Ошибка скачивания TikTok: {str(e)}", exc_info=True)
         return None
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
 
-async def download_pinterest_image(url: str) -> Optional[str]:
+async def download_pinterest_image(url: str, target_dir: str) -> Optional[str]:
     try:
         logger.info(f"Скачивание Pinterest изображения: {url}")
         
@@ -270,35 +507,17 @@ async def download_pinterest_image(url: str) -> Optional[str]:
             'quiet': True,
             'no_warnings': True,
             'format': 'best',
-            'outtmpl': 'downloads/%(id)s.%(ext)s',
             'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         }
         
-        os.makedirs('downloads', exist_ok=True)
-        
-        def download_sync():
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    if info and info.get('thumbnail'):
-                        return info['thumbnail']
-            except:
-                pass
-            return None
-        
-        loop = asyncio.get_event_loop()
-        thumbnail_url = await loop.run_in_executor(None, download_sync)
+        thumbnail_url = await ytdlp_worker.run(ytdlp_worker.extract_thumbnail, url, 'image', ydl_opts, timeout=ytdlp_worker.YTDLP_INFO_TIMEOUT)
         
         if thumbnail_url:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(thumbnail_url)
-                if response.status_code == 200:
-                    import hashlib
-                    filename = f"downloads/{hashlib.md5(url.encode()).hexdigest()}.jpg"
-                    with open(filename, 'wb') as f:
-                        f.write(response.content)
-                    logger.info(f"✅ Изображение скачано: {filename}")
-                    return filename
+            import hashlib
+            filename = os.path.join(target_dir, f"{hashlib.md5(url.encode()).hexdigest()}.jpg")
+            if await stream_to_file(thumbnail_url, filename):
+                logger.info(f"✅ Изображение скачано: {filename}")
+                return filename
         
         return None
         
@@ -306,7 +525,51 @@ async def download_pinterest_image(url: str) -> Optional[str]:
         logger.error(f"❌ Ошибка скачивания изображения: {str(e)}", exc_info=True)
         return None
 
+# Одинаковые скачивания, запущенные одновременно, выполняются один раз:
+# остальные вызовы ждут общую задачу и получают свою ссылку на тот же файл в кэше
+_inflight: Dict[str, Dict] = {}
+_inflight_stats = {'started': 0, 'joined': 0}
+
+async def _run_shared(key: str, coro) -> Optional[str]:
+    try:
+        filename = await coro
+    finally:
+        flight = _inflight.pop(key)
+    if filename:
+        if flight['waiters'] > 0:
+            disk_cache.retain(filename, flight['waiters'] - 1)
+        else:
+            # все ожидавшие отменены — ссылку из store() забрать некому
+            disk_cache.release(filename)
+    return filename
+
 async def download_video(url: str, quality: Optional[str] = None, audio_only: bool = False) -> Optional[str]:
+    key = delivery_key(url, quality, audio_only)
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = {'task': asyncio.ensure_future(_run_shared(key, _download_video(url, quality, audio_only))), 'waiters': 0}
+        _inflight[key] = flight
+        _inflight_stats['started'] += 1
+    else:
+        logger.info(f"Присоединение к уже идущему скачиванию: {key}")
+        _inflight_stats['joined'] += 1
+    
+    flight['waiters'] += 1
+    try:
+        return await asyncio.shield(flight['task'])
+    except asyncio.CancelledError:
+        # отменённый вызов не заберёт файл — возвращаем его ссылку
+        task = flight['task']
+        if task.done() and not task.cancelled() and task.exception() is None and task.result():
+            disk_cache.release(task.result())
+        else:
+            flight['waiters'] -= 1
+        raise
+
+def get_inflight_stats() -> Dict:
+    return {**_inflight_stats, 'active': len(_inflight)}
+
+async def _download_video(url: str, quality: Optional[str], audio_only: bool) -> Optional[str]:
     try:
         platform = 'pinterest' if 'pinterest.com' in url or 'pin.it' in url else 'tiktok'
         
@@ -315,86 +578,87 @@ async def download_video(url: str, quality: Optional[str] = None, audio_only: bo
         if platform == 'tiktok':
             return await download_tiktok_via_api(url, quality, audio_only)
         
-        if quality == 'image':
-            return await download_pinterest_image(url)
+        key = delivery_key(url, quality, audio_only)
+        cached = disk_cache.acquire(key)
+        if cached:
+            logger.info(f"Файл взят из кэша на диске: {cached}")
+            return cached
         
-        base_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'socket_timeout': 30,
-            'retries': 3,
-            'fragment_retries': 3,
-            'ignoreerrors': True,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Sec-Fetch-Mode': 'navigate',
-            }
-        }
-        
-        if audio_only:
-            ydl_opts = {
-                **base_opts,
-                'format': 'bestaudio/best',
-                'outtmpl': 'downloads/%(id)s.%(ext)s',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            }
-        else:
-            if quality:
-                height = quality.replace('p', '')
-                ydl_opts = {
-                    **base_opts,
-                    'format': f'bestvideo[height<={height}]+bestaudio/best[height<={height}]/best',
-                    'outtmpl': 'downloads/%(id)s.%(ext)s',
-                    'merge_output_format': 'mp4',
-                }
+        job_dir = disk_cache.temp_dir()
+        try:
+            if quality == 'image':
+                filename = await download_pinterest_image(url, job_dir)
             else:
-                ydl_opts = {
-                    **base_opts,
-                    'format': 'best',
-                    'outtmpl': 'downloads/%(id)s.%(ext)s',
-                }
-        
-        os.makedirs('downloads', exist_ok=True)
-        
-        def download_sync():
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    if not info:
-                        return None
-                    filename = ydl.prepare_filename(info)
-                    
-                    if audio_only:
-                        filename = filename.rsplit('.', 1)[0] + '.mp3'
-                    
-                    return filename
-            except Exception as e:
-                logger.error(f"Ошибка yt-dlp при скачивании: {e}")
-                return None
-        
-        loop = asyncio.get_event_loop()
-        filename = await loop.run_in_executor(None, download_sync)
-        
-        if filename and os.path.exists(filename):
-            file_size = os.path.getsize(filename) / (1024 * 1024)
-            logger.info(f"✅ Успешно скачано: {filename} ({file_size:.2f} MB)")
-            return filename
-        else:
-            logger.error(f"Ошибка скачивания: файл не найден")
-            return None
+                filename = await _download_with_ytdlp(url, quality, audio_only, job_dir)
+            return disk_cache.store(key, filename) if filename else None
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
             
     except Exception as e:
         logger.error(f"❌ Ошибка скачивания из {url}: {str(e)}", exc_info=True)
         logger.error(f"Тип ошибки: {type(e).__name__}")
         return None
 
+async def _download_with_ytdlp(url: str, quality: Optional[str], audio_only: bool, target_dir: str) -> Optional[str]:
+    outtmpl = '%(id)s.%(ext)s'
+    
+    base_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 30,
+        'retries': 3,
+        'fragment_retries': 3,
+        'ignoreerrors': True,
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+        'http_headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-us,en;q=0.5',
+            'Sec-Fetch-Mode': 'navigate',
+        }
+    }
+    
+    if audio_only:
+        profile = 'audio'
+        ydl_opts = {
+            **base_opts,
+            'format': 'bestaudio/best',
+            'outtmpl': outtmpl,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+        }
+    else:
+        if quality:
+            height = quality.replace('p', '')
+            profile = f"video-{height}"
+            ydl_opts = {
+                **base_opts,
+                'format': f'bestvideo[height<={height}]+bestaudio/best[height<={height}]/best',
+                'outtmpl': outtmpl,
+                'merge_output_format': 'mp4',
+            }
+        else:
+            profile = 'video-best'
+            ydl_opts = {
+                **base_opts,
+                'format': 'best',
+                'outtmpl': outtmpl,
+            }
+    
+    filename = await ytdlp_worker.run(ytdlp_worker.download, url, profile, ydl_opts, audio_only, target_dir, timeout=ytdlp_worker.YTDLP_DOWNLOAD_TIMEOUT)
+    
+    if filename and os.path.exists(filename):
+        file_size = os.path.getsize(filename) / (1024 * 1024)
+        logger.info(f"✅ Успешно скачано: {filename} ({file_size:.2f} MB)")
+        return filename
+    else:
+        logger.error(f"Ошибка скачивания: файл не найден")
+        return None
+
+
 def format_duration(seconds) -> str:
     if seconds is None:
         return "Неизвестно"
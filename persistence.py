@@ -0,0 +1,123 @@
+import json
+import asyncio
+import logging
+from typing import Dict, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+import database as db
+from ttl_cache import TTLCache
+from config import PERSISTENCE_UPDATE_INTERVAL, SESSION_VERSIONS_CACHE_SIZE, SESSION_VERSIONS_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# user_data хранится в Postgres (таблица user_sessions), поэтому апдейты одного пользователя
+# могут обрабатываться любым воркером или инстансом. Перед каждым апдейтом сверяется версия
+# документа: если его изменил другой процесс, данные перечитываются, иначе используется память.
+class PostgresPersistence(BasePersistence):
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=PERSISTENCE_UPDATE_INTERVAL,
+        )
+        self._versions = TTLCache(SESSION_VERSIONS_CACHE_SIZE, SESSION_VERSIONS_CACHE_TTL)
+        self._pending: Dict[int, dict] = {}
+        self._flush_scheduled = False
+
+    # Данные пользователей читаются лениво в refresh_user_data, а не все сразу при старте
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._pending:
+            # свои изменения ещё не записаны — они новее того, что лежит в БД
+            return
+        known = self._versions.get(user_id, 0)
+        try:
+            version, data = await db.load_user_session(user_id, known)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать сессию пользователя {user_id}: {e}")
+            return
+        if version is None:
+            return
+        if data is not None:
+            user_data.clear()
+            user_data.update(data)
+        self._versions.set(user_id, version)
+
+    # PTB вызывает update_user_data для всех изменённых пользователей разом;
+    # первый вызов уступает цикл остальным и записывает всё одним запросом
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending[user_id] = data
+        if self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        try:
+            await asyncio.sleep(0)
+        finally:
+            self._flush_scheduled = False
+        await self._write_pending()
+
+    async def _write_pending(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        sessions = {}
+        for user_id, data in pending.items():
+            try:
+                sessions[user_id] = json.dumps(data, ensure_ascii=False, default=str)
+            except (TypeError, ValueError) as e:
+                logger.error(f"user_data пользователя {user_id} не сериализуется в JSON: {e}")
+        try:
+            versions = await db.save_user_sessions(sessions)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить {len(sessions)} сессий: {e}")
+            # вернём в очередь, если за это время не появились более свежие данные
+            for user_id, data in pending.items():
+                self._pending.setdefault(user_id, data)
+            return
+        for user_id, version in versions.items():
+            self._versions.set(user_id, version)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._versions.pop(user_id)
+        await db.delete_user_session(user_id)
+
+    async def flush(self) -> None:
+        await self._write_pending()
+
+    # chat_data, bot_data, callback_data и диалоги бот не использует
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> Optional[tuple]:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    def stats(self) -> Dict:
+        return {'pending': len(self._pending), 'versions': self._versions.stats()}
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+from config import (
+    DOWNLOAD_WORKERS, DOWNLOAD_PLATFORM_WORKERS, DOWNLOAD_QUEUE_LIMIT,
+    DOWNLOAD_PRIORITY_RESERVED, DOWNLOAD_FREE_QUEUE_LIMIT, DOWNLOAD_FREE_MAX_WAIT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Планировщик скачиваний: очередь задач с общим лимитом и лимитами по платформам.
+# Очереди ведутся по пользователям и обходятся по кругу, чтобы массовая загрузка
+# одного пользователя не задерживала одиночные ссылки остальных.
+# Подписчики идут отдельной приоритетной полосой: она обслуживается первой и за ней закреплены
+# DOWNLOAD_PRIORITY_RESERVED воркеров, бесплатные задачи делят остаток и при перегрузке отклоняются.
+
+PRIORITY = 'priority'
+FREE = 'free'
+
+class QueueFull(Exception):
+    pass
+
+class DownloadJob:
+    def __init__(self, user_id: int, platform: str, lane: str, factory: Callable[[], Awaitable], discard: Optional[Callable[[Any], None]]):
+        self.user_id = user_id
+        self.platform = platform
+        self.lane = lane
+        self.factory = factory
+        self.discard = discard
+        self.future = asyncio.get_running_loop().create_future()
+        self.started = asyncio.Event()
+        self.enqueued_at = time.monotonic()
+        self.abandoned = False
+
+    # 0 — задача уже выполняется, 1 — следующая в очереди
+    def position(self) -> int:
+        return queue_position(self)
+
+    async def result(self):
+        try:
+            return await asyncio.shield(self.future)
+        except asyncio.CancelledError:
+            if not self.started.is_set():
+                _remove(self)
+                self.future.cancel()
+            else:
+                # результат уже никто не заберёт — его освободит сама задача
+                self.abandoned = True
+            raise
+
+# полоса -> user_id -> очередь задач пользователя; порядок ключей — порядок обхода
+_lanes: Dict[str, "OrderedDict[int, deque]"] = {PRIORITY: OrderedDict(), FREE: OrderedDict()}
+_queued = {PRIORITY: 0, FREE: 0}
+_running_by_lane = {PRIORITY: 0, FREE: 0}
+_running: Dict[str, int] = {}
+_running_total = 0
+_waits = {PRIORITY: deque(maxlen=1000), FREE: deque(maxlen=1000)}
+_stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'shed': 0, 'max_queued': 0}
+
+def submit(user_id: int, platform: str, factory: Callable[[], Awaitable], discard: Optional[Callable[[Any], None]] = None,
+           priority: bool = False) -> DownloadJob:
+    lane = PRIORITY if priority else FREE
+    queued_total = _queued[PRIORITY] + _queued[FREE]
+    if queued_total >= DOWNLOAD_QUEUE_LIMIT or (lane == FREE and _queued[FREE] >= DOWNLOAD_FREE_QUEUE_LIMIT):
+        _stats['rejected'] += 1
+        raise QueueFull(f"Очередь скачиваний заполнена ({lane}: {_queued[lane]})")
+
+    job = DownloadJob(user_id, platform, lane, factory, discard)
+    _lanes[lane].setdefault(user_id, deque()).append(job)
+    _queued[lane] += 1
+    _stats['submitted'] += 1
+    _stats['max_queued'] = max(_stats['max_queued'], queued_total + 1)
+    _dispatch()
+    return job
+
+def _platform_limit(platform: str) -> int:
+    return DOWNLOAD_PLATFORM_WORKERS.get(platform, DOWNLOAD_WORKERS)
+
+def _next_job(lane: str) -> Optional[DownloadJob]:
+    queues = _lanes[lane]
+    for user_id, queue in queues.items():
+        job = queue[0]
+        if _running.get(job.platform, 0) >= _platform_limit(job.platform):
+            continue
+        queue.popleft()
+        if queue:
+            queues.move_to_end(user_id)
+        else:
+            del queues[user_id]
+        _queued[lane] -= 1
+        return job
+    return None
+
+def _free_capacity() -> int:
+    return max(DOWNLOAD_WORKERS - DOWNLOAD_PRIORITY_RESERVED, 1)
+
+def _dispatch():
+    global _running_total
+    while _running_total < DOWNLOAD_WORKERS:
+        job = _next_job(PRIORITY)
+        if job is None and _running_by_lane[FREE] < _free_capacity():
+            job = _next_job(FREE)
+        if job is None:
+            return
+        waited = time.monotonic() - job.enqueued_at
+        if job.lane == FREE and waited > DOWNLOAD_FREE_MAX_WAIT:
+            # бесплатная задача прождала слишком долго — отклоняем, а не занимаем воркер
+            _stats['shed'] += 1
+            if not job.future.done():
+                job.future.set_exception(QueueFull(f"Задача ждала в очереди {waited:.0f} с"))
+            continue
+        _running_total += 1
+        _running_by_lane[job.lane] += 1
+        _running[job.platform] = _running.get(job.platform, 0) + 1
+        _waits[job.lane].append(waited)
+        job.started.set()
+        asyncio.create_task(_run(job))
+
+async def _run(job: DownloadJob):
+    global _running_total
+    try:
+        result = await job.factory()
+    except Exception as e:
+        _stats['failed'] += 1
+        if not job.future.done():
+            job.future.set_exception(e)
+    else:
+        _stats['completed'] += 1
+        if job.abandoned or job.future.done():
+            if result and job.discard:
+                job.discard(result)
+        else:
+            job.future.set_result(result)
+    finally:
+        # задачу отменили (CancelledError не ловится выше) — ожидающий получает обычную ошибку, а не зависает
+        if not job.future.done():
+            _stats['failed'] += 1
+            job.future.set_exception(RuntimeError("Задача скачивания отменена"))
+        _running_total -= 1
+        _running_by_lane[job.lane] -= 1
+        _running[job.platform] -= 1
+        _dispatch()
+
+def _remove(job: DownloadJob):
+    queues = _lanes[job.lane]
+    queue = queues.get(job.user_id)
+    if queue is None or job not in queue:
+        return
+    queue.remove(job)
+    _queued[job.lane] -= 1
+    if not queue:
+        del queues[job.user_id]
+
+# Позиция считается тем же круговым обходом, которым задачи выдаются на выполнение;
+# бесплатные задачи стоят после всей приоритетной полосы
+def queue_position(job: DownloadJob) -> int:
+    if job.started.is_set():
+        return 0
+    queues = list(_lanes[job.lane].values())
+    position = _queued[PRIORITY] if job.lane == FREE else 0
+    depth = 0
+    while any(depth < len(queue) for queue in queues):
+        for queue in queues:
+            if depth < len(queue):
+                position += 1
+                if queue[depth] is job:
+                    return position
+        depth += 1
+    return position
+
+def _lane_stats(lane: str) -> Dict:
+    waits = sorted(_waits[lane])
+    return {
+        'queued': _queued[lane],
+        'running': _running_by_lane[lane],
+        'users_waiting': len(_lanes[lane]),
+        'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+        'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.0,
+        'max_wait': waits[-1] if waits else 0.0,
+    }
+
+def get_stats() -> Dict:
+    return {
+        **_stats,
+        'queued': _queued[PRIORITY] + _queued[FREE],
+        'running': _running_total,
+        'running_by_platform': dict(_running),
+        'lanes': {lane: _lane_stats(lane) for lane in _lanes},
+    }
@@ -1,3 +1,4 @@
+import os
 import requests
 import sys
 
@@ -10,10 +11,16 @@ def set_webhook(webhook_url):
     
     print(f"Устанавливаем webhook: {full_webhook_url}")
     
-    response = requests.post(api_url, json={
+    payload = {
         'url': full_webhook_url,
         'allowed_updates': ['message', 'callback_query']
-    })
+    }
+    # Тот же секрет должен быть задан в WEBHOOK_SECRET у сервера — app.py проверяет заголовок
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    if secret_token:
+        payload['secret_token'] = secret_token
+    
+    response = requests.post(api_url, json=payload)
     
     result = response.json()
     
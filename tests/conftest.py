@@ -0,0 +1,49 @@
+import os
+import sys
+import asyncio
+import pytest
+
+# config.py требует токены при импорте; для тестов подставляем заглушки
+os.environ.setdefault('TELEGRAM_TOKEN', '123:test')
+os.environ.setdefault('YOOKASSA_SECRET_KEY', 'test')
+os.environ.setdefault('YOOKASSA_SHOP_ID', 'test')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+# Тесты с Postgres запускаются только при заданном TEST_DATABASE_URL (отдельная пустая база).
+# Фикстура возвращает функцию, которая выполняет сценарий в своём event loop с открытым пулом.
+@pytest.fixture
+def run_db():
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL не задан')
+    import database as db
+    db.DATABASE_URL = TEST_DATABASE_URL
+
+    def run(scenario):
+        async def wrapper():
+            await db.init_db()
+            try:
+                async with db.db() as conn:
+                    await conn.execute('TRUNCATE users,subscriptions,downloads,download_quota,quota_reservations,update_queue,processed_updates,user_sessions CASCADE')
+                return await scenario()
+            finally:
+                await db.close_db()
+        return asyncio.run(wrapper())
+    return run
+
+# Дисковый кэш во временном каталоге, с маленьким бюджетом и чистым состоянием модуля
+@pytest.fixture
+def disk_cache_dirs(tmp_path, monkeypatch):
+    import disk_cache
+    monkeypatch.setattr(disk_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(disk_cache, 'TEMP_ROOT', str(tmp_path / 'tmp'))
+    monkeypatch.setattr(disk_cache, 'DOWNLOAD_CACHE_MAX_BYTES_PER_PROCESS', 250)
+    monkeypatch.setattr(disk_cache, 'DOWNLOAD_CACHE_STALE_SECONDS', 3600)
+    monkeypatch.setattr(disk_cache, '_entries', disk_cache.OrderedDict())
+    monkeypatch.setattr(disk_cache, '_paths', {})
+    monkeypatch.setattr(disk_cache, '_orphans', {})
+    monkeypatch.setattr(disk_cache, '_total_bytes', 0)
+    monkeypatch.setattr(disk_cache, '_loaded', False)
+    return tmp_path
@@ -0,0 +1,69 @@
+import os
+import json
+import socket
+import asyncio
+import pytest
+import disk_cache
+
+@pytest.fixture(autouse=True)
+def cache_dirs(disk_cache_dirs):
+    return disk_cache_dirs
+
+def _download(name: str, size: int = 100) -> str:
+    path = os.path.join(disk_cache.temp_dir(), name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+def test_least_recently_used_unreferenced_entry_is_evicted():
+    a = disk_cache.store('a', _download('a.mp4'))
+    b = disk_cache.store('b', _download('b.mp4'))
+    disk_cache.release(a)
+    disk_cache.release(b)
+    assert disk_cache.acquire('a') == a
+    # c не помещается: вытесняется b (a только что использован и занят)
+    c = disk_cache.store('c', _download('c.mp4'))
+    assert os.path.exists(a) and os.path.exists(c) and not os.path.exists(b)
+    assert disk_cache.acquire('b') is None
+    assert disk_cache.get_stats()['bytes'] == 200
+
+def test_forgotten_entry_is_removed_after_last_release():
+    a = disk_cache.store('a', _download('a.mp4'))
+    disk_cache.retain(a, 2)
+    disk_cache.forget('a')
+    disk_cache.release(a)
+    disk_cache.release(a)
+    assert os.path.exists(a)
+    disk_cache.release(a)
+    assert not os.path.exists(a)
+
+def _other_owner_files(root, owner: str, key: str):
+    entry_dir = root / 'cache' / f'{owner}-entry'
+    entry_dir.mkdir(parents=True)
+    path = entry_dir / 'v.mp4'
+    path.write_bytes(b'y' * 10)
+    (root / 'cache' / f'index-{owner}.json').write_text(json.dumps({key: {'path': str(path), 'size': 10, 'last_access': 1}}))
+    temp = root / 'tmp' / owner / 'job'
+    temp.mkdir(parents=True)
+    return path, temp
+
+def test_start_keeps_live_owner_files_and_adopts_dead_owner_index(cache_dirs):
+    host = socket.gethostname()
+    live_path, live_temp = _other_owner_files(cache_dirs, f'{host}-{os.getppid()}', 'live')
+    dead_path, dead_temp = _other_owner_files(cache_dirs, f'{host}-999999999', 'dead')
+
+    assert disk_cache.acquire('live') is None
+    assert live_path.exists() and live_temp.exists()
+    assert disk_cache.acquire('dead') == str(dead_path)
+    assert not dead_temp.exists()
+    assert not (cache_dirs / 'cache' / f'index-{host}-999999999.json').exists()
+
+def test_index_is_written_off_the_event_loop():
+    async def scenario():
+        disk_cache.store('a', _download('a.mp4'))
+        index = disk_cache._index_file(disk_cache._owner)
+        await disk_cache._save_task
+        with open(index) as f:
+            return json.load(f)
+
+    assert list(asyncio.run(scenario())) == ['a']
@@ -0,0 +1,49 @@
+import asyncio
+import httpx
+import pytest
+import downloader
+
+URL = 'https://www.tiktok.com/@u/video/456'
+
+@pytest.fixture
+def tikwm(monkeypatch):
+    state = {'calls': 0, 'reply': None}
+
+    async def fake_request(method, url, **kwargs):
+        state['calls'] += 1
+        reply = state['reply']
+        if isinstance(reply, Exception):
+            raise reply
+        status, body = reply
+        return httpx.Response(status, json=body)
+
+    async def no_db(*args):
+        raise RuntimeError('нет БД')
+
+    monkeypatch.setattr(downloader, 'http_request', fake_request)
+    monkeypatch.setattr(downloader.db, 'get_cached_metadata', no_db)
+    monkeypatch.setattr(downloader.db, 'store_cached_metadata', no_db)
+    monkeypatch.setattr(downloader, '_metadata_cache', downloader.TTLCache(10, 60))
+    monkeypatch.setattr(downloader, '_tiktok_resolutions', downloader.TTLCache(10, 60))
+    return state
+
+@pytest.mark.parametrize('reply', [
+    httpx.ReadTimeout('timeout'),
+    (429, {}),
+    (503, {}),
+    (200, {'code': -1, 'msg': 'Free Api Limit: 1 request/second.'}),
+])
+def test_transient_failures_are_not_cached(tikwm, reply):
+    tikwm['reply'] = reply
+    assert asyncio.run(downloader.extract_video_info_async(URL)) is None
+    assert len(downloader._metadata_cache) == 0
+
+    tikwm['reply'] = (200, {'code': 0, 'data': {'title': 't', 'play': 'https://cdn/v.mp4'}})
+    info = asyncio.run(downloader.extract_video_info_async(URL))
+    assert info['title'] == 't' and tikwm['calls'] == 2
+
+def test_definite_negative_is_cached(tikwm):
+    tikwm['reply'] = (200, {'code': -1, 'msg': 'Url parsing is failed! Please check url.'})
+    assert asyncio.run(downloader.extract_video_info_async(URL)) is None
+    assert asyncio.run(downloader.extract_video_info_async(URL)) is None
+    assert tikwm['calls'] == 1
@@ -0,0 +1,60 @@
+import asyncio
+import database as db
+
+def test_reserve_commit_release(run_db):
+    async def scenario():
+        await db.add_user(1)
+        reservation = await db.reserve_quota(1, 3, 5)
+        assert reservation['slots'] == 3
+        # резерв занимает лимит до фиксации
+        assert (await db.get_quota_status(1, 5))['remaining'] == 2
+        assert (await db.reserve_quota(1, 5, 5))['slots'] == 2
+        assert await db.reserve_quota(1, 1, 5) is None
+
+        await db.commit_quota(reservation['id'], 1, 'tiktok')
+        assert await db.get_download_count_24h(1) == 1
+        # оставшиеся слоты резерва возвращаются в лимит
+        await db.release_quota(reservation['id'])
+        status = await db.get_quota_status(1, 5)
+        assert status['used'] == 3
+        assert status['remaining'] == 2
+
+    run_db(scenario)
+
+def test_concurrent_reservations_without_user_row_respect_limit(run_db):
+    async def scenario():
+        results = await asyncio.gather(*(db.reserve_quota(2, 1, 3) for _ in range(10)))
+        assert sum(r['slots'] for r in results if r) == 3
+        assert (await db.get_quota_status(2, 3))['remaining'] == 0
+
+    run_db(scenario)
+
+def test_bucket_overlapping_window_boundary_is_counted(run_db):
+    async def scenario():
+        async with db.db() as conn:
+            # час корзины -24ч ещё пересекается с окном, корзина -25ч уже целиком вне его
+            await conn.execute('''
+                INSERT INTO download_quota (user_id, bucket_start, downloads) VALUES
+                    (3, date_trunc('hour', LOCALTIMESTAMP) - INTERVAL '24 hours', 2),
+                    (3, date_trunc('hour', LOCALTIMESTAMP) - INTERVAL '25 hours', 5)
+            ''')
+        assert await db.get_download_count_24h(3) == 2
+        status = await db.get_quota_status(3, 2)
+        assert status['remaining'] == 0
+        # слот освободится, когда корзина выйдет из окна, — не позже чем через час
+        assert 0 < status['next_slot_in'].total_seconds() <= 3600
+        assert await db.reserve_quota(3, 1, 2) is None
+
+    run_db(scenario)
+
+def test_unlimited_subscription_is_read_fresh(run_db):
+    async def scenario():
+        await db.add_user(4)
+        assert (await db.reserve_quota(4, 2, 2))['slots'] == 2
+        # оплата на другом инстансе: кэш функций этого процесса о ней не знает
+        assert 'unlimited' not in await db.get_active_features(4)
+        async with db.db() as conn:
+            await conn.execute("INSERT INTO subscriptions (user_id, feature, expires_at) VALUES (4, 'unlimited', NOW() + INTERVAL '1 day')")
+        assert await db.reserve_quota(4, 5, 2) == {'id': None, 'slots': 5}
+
+    run_db(scenario)
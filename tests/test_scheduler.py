@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+import scheduler
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(scheduler, 'DOWNLOAD_WORKERS', 2)
+    monkeypatch.setattr(scheduler, 'DOWNLOAD_PRIORITY_RESERVED', 1)
+    monkeypatch.setattr(scheduler, 'DOWNLOAD_PLATFORM_WORKERS', {})
+    monkeypatch.setattr(scheduler, 'DOWNLOAD_FREE_MAX_WAIT', 300)
+
+def test_users_are_served_round_robin():
+    async def scenario():
+        started = []
+        gate = asyncio.Event()
+
+        def job(name):
+            async def factory():
+                started.append(name)
+                await gate.wait()
+            return factory
+
+        # оба воркера заняты, очередь: три задачи пользователя 1 и одна пользователя 2
+        busy = [scheduler.submit(9, 'tiktok', job('busy'), priority=True) for _ in range(2)]
+        queued = [scheduler.submit(1, 'tiktok', job(f'a{i}'), priority=True) for i in range(3)]
+        queued.append(scheduler.submit(2, 'tiktok', job('b0'), priority=True))
+        assert [j.position() for j in queued] == [1, 3, 4, 2]
+        gate.set()
+        await asyncio.gather(*(j.result() for j in busy + queued))
+        return started[2:]
+
+    assert asyncio.run(scenario()) == ['a0', 'b0', 'a1', 'a2']
+
+def test_free_lane_leaves_reserved_worker_for_priority():
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def factory():
+            await gate.wait()
+
+        free = [scheduler.submit(1, 'tiktok', factory), scheduler.submit(2, 'tiktok', factory)]
+        await asyncio.sleep(0)
+        assert free[0].started.is_set() and not free[1].started.is_set()
+        paid = scheduler.submit(3, 'tiktok', factory, priority=True)
+        assert paid.started.is_set()
+        gate.set()
+        await asyncio.gather(*(j.result() for j in free + [paid]))
+
+    asyncio.run(scenario())
+
+def test_cancelled_job_fails_waiter_instead_of_hanging():
+    async def scenario():
+        started = asyncio.Event()
+
+        async def factory():
+            started.set()
+            await asyncio.sleep(60)
+
+        job = scheduler.submit(1, 'tiktok', factory)
+        await started.wait()
+        for task in asyncio.all_tasks():
+            if task.get_coro().__name__ == '_run':
+                task.cancel()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(job.result(), 1)
+        assert scheduler.get_stats()['running'] == 0
+
+    asyncio.run(scenario())
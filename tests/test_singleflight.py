@@ -0,0 +1,67 @@
+import os
+import asyncio
+import pytest
+import disk_cache
+import downloader
+
+@pytest.fixture
+def slow_download(disk_cache_dirs, monkeypatch):
+    state = {'calls': 0, 'release': None}
+
+    async def fake_download(url, quality, audio_only):
+        state['calls'] += 1
+        await state['release'].wait()
+        path = os.path.join(disk_cache.temp_dir(), 'v.mp4')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 10)
+        return disk_cache.store(downloader.delivery_key(url, quality, audio_only), path)
+
+    monkeypatch.setattr(downloader, '_download_video', fake_download)
+    return state
+
+def _refs(path: str) -> int:
+    return disk_cache._entries[disk_cache._paths[path]]['refs']
+
+def test_concurrent_callers_share_one_download(slow_download):
+    async def scenario():
+        slow_download['release'] = asyncio.Event()
+        callers = [asyncio.create_task(downloader.download_video('https://t/1', '720')) for _ in range(3)]
+        await asyncio.sleep(0)
+        slow_download['release'].set()
+        paths = await asyncio.gather(*callers)
+        assert len(set(paths)) == 1 and _refs(paths[0]) == 3
+        for path in paths:
+            disk_cache.release(path)
+        assert _refs(paths[0]) == 0
+
+    asyncio.run(scenario())
+    assert slow_download['calls'] == 1
+
+def test_file_is_not_pinned_when_every_caller_is_cancelled(slow_download):
+    async def scenario():
+        slow_download['release'] = asyncio.Event()
+        callers = [asyncio.create_task(downloader.download_video('https://t/2', '720')) for _ in range(2)]
+        await asyncio.sleep(0)
+        task = downloader._inflight[downloader.delivery_key('https://t/2', '720', False)]['task']
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        slow_download['release'].set()
+        return await task
+
+    path = asyncio.run(scenario())
+    assert _refs(path) == 0
+
+def test_remaining_caller_keeps_its_reference(slow_download):
+    async def scenario():
+        slow_download['release'] = asyncio.Event()
+        cancelled = asyncio.create_task(downloader.download_video('https://t/3', '720'))
+        kept = asyncio.create_task(downloader.download_video('https://t/3', '720'))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        slow_download['release'].set()
+        return await kept
+
+    path = asyncio.run(scenario())
+    assert _refs(path) == 1
@@ -0,0 +1,28 @@
+import asyncio
+import httpx
+import pytest
+import downloader
+
+BODY = bytes(range(256)) * (3 * 4096 + 17)
+
+@pytest.fixture
+def http(monkeypatch):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == '/missing':
+            return httpx.Response(404)
+        return httpx.Response(200, content=BODY)
+
+    monkeypatch.setattr(downloader, '_http_client', httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(downloader, '_host_limits', {})
+
+def test_file_is_written_completely(http, tmp_path):
+    target = tmp_path / 'video.mp4'
+    stats = asyncio.run(downloader.stream_to_file('https://cdn.example/video.mp4', str(target)))
+    assert stats['bytes'] == len(BODY)
+    assert target.read_bytes() == BODY
+    assert list(tmp_path.iterdir()) == [target]
+
+def test_error_status_leaves_no_files(http, tmp_path):
+    target = tmp_path / 'video.mp4'
+    assert asyncio.run(downloader.stream_to_file('https://cdn.example/missing', str(target))) is None
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,37 @@
+import asyncio
+import httpx
+import disk_cache
+import downloader
+
+URL = 'https://www.tiktok.com/@u/video/123'
+
+def test_stored_url_timeout_falls_back_to_fresh_lookup(disk_cache_dirs, monkeypatch):
+    fresh = {'play': 'https://cdn/fresh.mp4'}
+    requested = []
+
+    async def fake_stream(url, filename):
+        requested.append(url)
+        if url == 'https://cdn/stale.mp4':
+            raise httpx.ConnectTimeout('timeout')
+        with open(filename, 'wb') as f:
+            f.write(b'x' * 10)
+        return {'bytes': 10}
+
+    async def fake_fetch(url):
+        return fresh
+
+    monkeypatch.setattr(downloader, 'stream_to_file', fake_stream)
+    monkeypatch.setattr(downloader, '_fetch_tikwm', fake_fetch)
+    monkeypatch.setattr(downloader, '_tiktok_resolutions', downloader.TTLCache(10, 60))
+    downloader._remember_tiktok_resolution(URL, {'play': 'https://cdn/stale.mp4'})
+
+    path = asyncio.run(downloader.download_tiktok_via_api(URL, 'sd'))
+    assert path and requested == ['https://cdn/stale.mp4', 'https://cdn/fresh.mp4']
+    disk_cache.release(path)
+
+def test_resolution_lookup_does_not_count_metadata_cache_stats(monkeypatch):
+    cache = downloader.TTLCache(10, 60)
+    monkeypatch.setattr(downloader, '_metadata_cache', cache)
+    monkeypatch.setattr(downloader, '_tiktok_resolutions', downloader.TTLCache(10, 60))
+    assert downloader._get_tiktok_resolution(URL) is None
+    assert cache.stats()['misses'] == 0 and cache.stats()['hits'] == 0
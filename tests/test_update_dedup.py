@@ -0,0 +1,62 @@
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+import database as db
+import updates
+
+async def _expire_leases():
+    async with db.db() as conn:
+        await conn.execute("UPDATE update_queue SET available_at=LOCALTIMESTAMP-INTERVAL '1 second'")
+
+def test_retry_after_expired_lease_takes_over_the_mark(run_db):
+    async def scenario():
+        await db.enqueue_update({'update_id': 10})
+        [first] = await db.claim_updates(1)
+        assert await db.mark_update_seen(10, first['id'], first['lease_token'])
+        # тот же держатель и повторная доставка от Telegram отдельной строкой — дубли
+        assert not await db.mark_update_seen(10, first['id'], first['lease_token'])
+        await db.enqueue_update({'update_id': 10})
+        [redelivered] = await db.claim_updates(1)
+        assert not await db.mark_update_seen(10, redelivered['id'], redelivered['lease_token'])
+
+        await _expire_leases()
+        retries = {r['id']: r for r in await db.claim_updates(5)}
+        retry = retries[first['id']]
+        assert await db.mark_update_seen(10, retry['id'], retry['lease_token'])
+        assert not await db.mark_update_seen(10, redelivered['id'], retries[redelivered['id']]['lease_token'])
+
+    run_db(scenario)
+
+def test_polling_updates_are_marked_once(run_db):
+    async def scenario():
+        assert await db.mark_update_seen(11)
+        assert not await db.mark_update_seen(11)
+
+    run_db(scenario)
+
+def test_handler_drops_update_seen_in_memory(run_db):
+    async def scenario():
+        update = Update(update_id=12)
+        await updates.drop_duplicate_update(update, None)
+        with pytest.raises(ApplicationHandlerStop):
+            await updates.drop_duplicate_update(update, None)
+
+    run_db(scenario)
+
+def test_handler_lets_retry_of_dead_holder_through(run_db):
+    async def scenario():
+        await db.enqueue_update({'update_id': 13})
+        [first] = await db.claim_updates(1)
+        update = Update(update_id=13)
+        updates.set_lease(13, first['id'], first['lease_token'], first['attempts'])
+        await updates.drop_duplicate_update(update, None)
+
+        await _expire_leases()
+        [retry] = await db.claim_updates(1)
+        updates.set_lease(13, retry['id'], retry['lease_token'], retry['attempts'])
+        try:
+            await updates.drop_duplicate_update(update, None)
+        finally:
+            updates.clear_lease(13)
+
+    run_db(scenario)
@@ -0,0 +1,93 @@
+import asyncio
+from telegram import Chat, Message, Update, User
+from updates import PerUserUpdateProcessor
+
+def _update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, 'user', False)
+    message = Message(update_id, None, Chat(user_id, 'private'), from_user=user, text='x')
+    return Update(update_id, message=message)
+
+def test_updates_of_one_user_run_in_order():
+    async def scenario():
+        processor = PerUserUpdateProcessor(8)
+        order = []
+
+        async def handle(n):
+            await asyncio.sleep(0.01 * (5 - n))
+            order.append(n)
+
+        await asyncio.gather(*(processor.process_update(_update(n, 1), handle(n)) for n in range(5)))
+        return order
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+
+def test_waiting_updates_do_not_take_slots_from_other_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        release = asyncio.Event()
+        done = []
+
+        async def slow(n):
+            await release.wait()
+            done.append(n)
+
+        async def fast():
+            done.append('other')
+
+        # пачка апдейтов одного пользователя: один выполняется, остальные ждут своей очереди
+        busy = [asyncio.create_task(processor.process_update(_update(n, 1), slow(n))) for n in range(10)]
+        await asyncio.sleep(0)
+        assert processor.waiting_updates == 9
+        await asyncio.wait_for(processor.process_update(_update(100, 2), fast()), 1)
+        assert done == ['other']
+
+        release.set()
+        await asyncio.gather(*busy)
+        assert processor.stats()['users_active'] == 0
+        return processor.peak_concurrent_updates
+
+    assert asyncio.run(scenario()) <= 2
+
+def test_queue_worker_keeps_claiming_while_one_user_is_backlogged(monkeypatch):
+    import app
+
+    async def scenario():
+        processor = PerUserUpdateProcessor(8)
+        monkeypatch.setattr(app.application, '_update_processor', processor)
+        monkeypatch.setattr(app, 'UPDATE_WORKERS', 2)
+        queue = [(n, 1) for n in range(6)] + [(100, 2)]
+        release = asyncio.Event()
+        handled = []
+
+        async def claim_updates(limit):
+            claimed, queue[:limit] = queue[:limit], []
+            return claimed
+
+        async def process_queued_update(row):
+            update_id, user_id = row
+
+            async def handle():
+                if user_id == 1:
+                    await release.wait()
+                handled.append(update_id)
+
+            await processor.process_update(_update(update_id, user_id), handle())
+
+        monkeypatch.setattr(app.db, 'claim_updates', claim_updates)
+        monkeypatch.setattr(app, 'process_queued_update', process_queued_update)
+        worker = asyncio.create_task(app.update_worker())
+        try:
+            for _ in range(100):
+                if 100 in handled:
+                    break
+                await asyncio.sleep(0.01)
+            assert handled == [100]
+        finally:
+            release.set()
+            for _ in range(100):
+                if len(handled) == 7:
+                    break
+                await asyncio.sleep(0.01)
+            worker.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+import database as db
+
+async def _expire_leases():
+    async with db.db() as conn:
+        await conn.execute("UPDATE update_queue SET available_at=LOCALTIMESTAMP-INTERVAL '1 second'")
+
+def test_claimed_update_is_hidden_while_lease_is_extended(run_db):
+    async def scenario():
+        await db.enqueue_update({'update_id': 1})
+        [row] = await db.claim_updates(5)
+        assert row['payload'] == {'update_id': 1} and row['attempts'] == 1
+        assert await db.claim_updates(5) == []
+        assert await db.extend_update_leases({row['id']: row['lease_token']}) == {row['id']}
+        assert await db.claim_updates(5) == []
+
+    run_db(scenario)
+
+def test_expired_lease_moves_update_to_new_holder(run_db):
+    async def scenario():
+        await db.enqueue_update({'update_id': 2})
+        [first] = await db.claim_updates(1)
+        await _expire_leases()
+        [second] = await db.claim_updates(1)
+        assert second['id'] == first['id'] and second['attempts'] == 2
+        assert second['lease_token'] != first['lease_token']
+
+        # прежний держатель аренду не продлит и чужой апдейт не удалит
+        assert await db.extend_update_leases({first['id']: first['lease_token']}) == set()
+        await db.complete_update(first['id'], first['lease_token'])
+        await _expire_leases()
+        [third] = await db.claim_updates(1)
+        await db.complete_update(third['id'], third['lease_token'])
+        await _expire_leases()
+        assert await db.claim_updates(1) == []
+
+    run_db(scenario)
+
+def test_update_is_dropped_after_max_attempts(run_db):
+    async def scenario():
+        await db.enqueue_update({'update_id': 3})
+        for _ in range(db.UPDATE_QUEUE_MAX_ATTEMPTS):
+            assert len(await db.claim_updates(1)) == 1
+            await _expire_leases()
+        assert await db.claim_updates(1) == []
+
+    run_db(scenario)
@@ -0,0 +1,39 @@
+import os
+import time
+import asyncio
+import pytest
+import ytdlp_worker
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(ytdlp_worker, 'YTDLP_WORKERS', 2)
+    yield
+    ytdlp_worker.shutdown_pool()
+
+def test_timeout_kills_only_the_stuck_worker(pool):
+    async def scenario():
+        ytdlp_worker.start_pool()
+        stuck = ytdlp_worker.run(time.sleep, 30, timeout=1)
+        healthy = ytdlp_worker.run(time.sleep, 2, timeout=30)
+        results = await asyncio.gather(stuck, healthy, return_exceptions=True)
+        assert isinstance(results[0], asyncio.TimeoutError)
+        assert results[1] is None
+        # после перезапуска пул снова выполняет задачи
+        assert await ytdlp_worker.run(os.getpid, timeout=30) != os.getpid()
+
+    before = dict(ytdlp_worker.get_stats())
+    asyncio.run(scenario())
+    stats = ytdlp_worker.get_stats()
+    assert stats['timeouts'] - before['timeouts'] == 1
+    assert stats['restarts'] - before['restarts'] == 1
+    assert stats['busy'] == 0
+
+def test_extract_info_omits_missing_fields(monkeypatch):
+    class FakeYDL:
+        def extract_info(self, url, download):
+            return {'title': None, 'duration': 12, 'formats': None}
+
+    monkeypatch.setattr(ytdlp_worker, '_get_ydl', lambda profile, opts: FakeYDL())
+    info = ytdlp_worker.extract_info('https://example.com/v', 'info', {})
+    assert info == {'duration': 12, 'formats': []}
+    assert info.get('title', 'Без названия') == 'Без названия'
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, BaseUpdateProcessor, ContextTypes
+import database as db
+from ttl_cache import TTLCache
+from config import UPDATE_DEDUP_CACHE_SIZE, UPDATE_DEDUP_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Отсев повторно доставленных апдейтов: Telegram повторяет апдейт, если вебхук отвечал слишком долго.
+# Недавние update_id помним в памяти, а таблица processed_updates общая для всех инстансов.
+UPDATE_DEDUP_CLEANUP_INTERVAL = 600
+
+_seen = TTLCache(UPDATE_DEDUP_CACHE_SIZE, UPDATE_DEDUP_CACHE_TTL)
+# update_id -> (queue_id, lease_token, attempts) апдейтов из очереди в Postgres
+_leases: Dict[int, tuple] = {}
+_stats = {'duplicates': 0, 'db_errors': 0}
+_last_cleanup = time.monotonic()
+
+# Обработчик в группе -1: выполняется раньше всех остальных и останавливает обработку повтора
+async def drop_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _last_cleanup
+    update_id = update.update_id
+    queue_id, lease_token, attempts = _leases.get(update_id, (None, None, 1))
+    # повторную попытку после истёкшей аренды решает только Postgres: прошлый держатель мог быть в этом же процессе
+    if attempts == 1 and _seen.get(update_id):
+        _stats['duplicates'] += 1
+        logger.info(f"Повтор апдейта {update_id} отброшен")
+        raise ApplicationHandlerStop
+    _seen.set(update_id, True)
+
+    try:
+        first_time = await db.mark_update_seen(update_id, queue_id, lease_token)
+        if time.monotonic() - _last_cleanup > UPDATE_DEDUP_CLEANUP_INTERVAL:
+            _last_cleanup = time.monotonic()
+            await db.cleanup_processed_updates()
+    except Exception as e:
+        # без БД лучше обработать апдейт дважды, чем потерять его
+        logger.warning(f"Не удалось проверить update_id {update_id}: {e}")
+        _stats['db_errors'] += 1
+        return
+
+    if not first_time:
+        _stats['duplicates'] += 1
+        logger.info(f"Повтор апдейта {update_id} отброшен (уже обработан другим инстансом)")
+        raise ApplicationHandlerStop
+
+# Аренда апдейта из очереди: отметка об обработке привязывается к ней, чтобы после падения
+# держателя апдейт можно было обработать заново, а живой держатель не получил дубль
+def set_lease(update_id: int, queue_id: int, lease_token, attempts: int):
+    _leases[update_id] = (queue_id, lease_token, attempts)
+
+def clear_lease(update_id: int):
+    _leases.pop(update_id, None)
+
+def get_stats() -> dict:
+    return {**_stats, 'memory': _seen.stats()}
+
+# Апдейты разных пользователей обрабатываются параллельно (не больше max_concurrent_updates),
+# а апдейты одного пользователя — строго по очереди, чтобы не ломались сценарии в user_data
+# (admin_action, mass_urls и т.п.). Блокировка пользователя берётся раньше общего семафора:
+# апдейты, ждущие своей очереди, не занимают места, нужные апдейтам других пользователей.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # user_id -> [lock, сколько апдейтов пользователя выполняется или ждёт]
+        self._users: Dict[int, list] = {}
+        self.peak_concurrent_updates = 0
+
+    @staticmethod
+    def _user_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    # В BaseUpdateProcessor.process_update семафор берётся до do_process_update, поэтому метод переопределён
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._user_key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._users[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.peak_concurrent_updates = max(self.peak_concurrent_updates, self.current_concurrent_updates)
+        await coroutine
+
+    # Апдейты, которые ждут завершения предыдущего апдейта того же пользователя
+    @property
+    def waiting_updates(self) -> int:
+        return sum(entry[1] - 1 for entry in self._users.values())
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict:
+        return {
+            'max_concurrent': self.max_concurrent_updates,
+            'processing': self.current_concurrent_updates,
+            'peak': self.peak_concurrent_updates,
+            'users_active': len(self._users),
+            'waiting': self.waiting_updates,
+        }
@@ -0,0 +1,189 @@
+import signal
+import asyncio
+import logging
+import multiprocessing
+from typing import Dict, List, Optional, Set
+import yt_dlp
+from config import YTDLP_WORKERS, YTDLP_INFO_TIMEOUT, YTDLP_DOWNLOAD_TIMEOUT, YTDLP_INSTANCE_MAX_USES
+
+logger = logging.getLogger(__name__)
+
+# yt-dlp работает в отдельных процессах: тяжёлое извлечение на чистом Python
+# не конкурирует за GIL с event loop, а зависшую задачу можно завершить вместе с процессом.
+_stats = {'tasks': 0, 'timeouts': 0, 'restarts': 0}
+
+# ---------- Функции, выполняемые в процессах пула ----------
+
+def _init_worker():
+    # Ctrl+C обрабатывает родительский процесс; экстракторы загружаем один раз при старте
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        ydl.get_info_extractor('Pinterest')
+
+# В каждом процессе держим по одному готовому YoutubeDL на профиль опций (info, image, audio, video-<высота>):
+# таблицы экстракторов, заголовки и cookies настраиваются один раз. Экземпляр пересоздаётся
+# после YTDLP_INSTANCE_MAX_USES вызовов или после ошибки.
+_instances: Dict[str, list] = {}
+
+def _get_ydl(profile: str, opts: Dict) -> yt_dlp.YoutubeDL:
+    entry = _instances.get(profile)
+    if entry is None or entry[1] >= YTDLP_INSTANCE_MAX_USES:
+        _drop_ydl(profile)
+        entry = _instances[profile] = [yt_dlp.YoutubeDL(opts), 0]
+    entry[1] += 1
+    return entry[0]
+
+def _drop_ydl(profile: str):
+    entry = _instances.pop(profile, None)
+    if entry is not None:
+        try:
+            entry[0].close()
+        except Exception:
+            pass
+
+# Из процесса возвращаем только нужные поля, а не весь info-словарь yt-dlp
+def extract_info(url: str, profile: str, opts: Dict) -> Optional[Dict]:
+    try:
+        info = _get_ydl(profile, opts).extract_info(url, download=False)
+    except Exception as e:
+        logger.error(f"Ошибка yt-dlp: {e}")
+        _drop_ydl(profile)
+        return None
+    if not info:
+        _drop_ydl(profile)
+        return None
+    # отсутствующие поля не передаём, чтобы у вызывающего сработали значения по умолчанию в info.get()
+    result = {key: info[key] for key in ('title', 'duration', 'thumbnail') if info.get(key) is not None}
+    result['formats'] = [
+        {'format_id': f.get('format_id'), 'vcodec': f.get('vcodec'), 'height': f.get('height')}
+        for f in info.get('formats') or []
+    ]
+    return result
+
+def extract_thumbnail(url: str, profile: str, opts: Dict) -> Optional[str]:
+    try:
+        info = _get_ydl(profile, opts).extract_info(url, download=False)
+        if info and info.get('thumbnail'):
+            return info['thumbnail']
+    except Exception:
+        pass
+    _drop_ydl(profile)
+    return None
+
+# Каталог задачи передаётся через params['paths'] при каждом вызове, шаблон имени файла общий
+def download(url: str, profile: str, opts: Dict, audio_only: bool, target_dir: str) -> Optional[str]:
+    try:
+        ydl = _get_ydl(profile, opts)
+        ydl.params['paths'] = {'home': target_dir}
+        info = ydl.extract_info(url, download=True)
+        if not info:
+            _drop_ydl(profile)
+            return None
+        filename = ydl.prepare_filename(info)
+
+        if audio_only:
+            filename = filename.rsplit('.', 1)[0] + '.mp3'
+
+        return filename
+    except Exception as e:
+        logger.error(f"Ошибка yt-dlp при скачивании: {e}")
+        _drop_ydl(profile)
+        return None
+
+# Цикл процесса-воркера: задачи приходят по каналу по одной, результат отправляется обратно
+def _worker_main(conn):
+    _init_worker()
+    while True:
+        try:
+            func, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            reply = ('ok', func(*args))
+        except Exception as e:
+            reply = ('error', f"{type(e).__name__}: {e}")
+        conn.send(reply)
+
+# ---------- Управление пулом в основном процессе ----------
+
+# Процессы запускаются через spawn: fork из процесса с потоками и работающим event loop может
+# унаследовать захваченные блокировки. У каждого процесса свой канал, поэтому зависшую задачу
+# можно завершить вместе с её процессом, не трогая задачи других пользователей.
+_ctx = multiprocessing.get_context('spawn')
+
+class _Worker:
+    def __init__(self):
+        self.conn, child_conn = _ctx.Pipe()
+        self.process = _ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    # сначала завершаем процесс: поток, ждущий ответа в recv(), получит EOF, и только потом закрываем канал
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+_idle: List[_Worker] = []
+_busy: Set[_Worker] = set()
+_slots: Optional[asyncio.Semaphore] = None
+
+def start_pool():
+    global _slots
+    if _slots is not None:
+        return
+    _slots = asyncio.Semaphore(YTDLP_WORKERS)
+    for _ in range(YTDLP_WORKERS):
+        _idle.append(_Worker())
+    logger.info(f"Пул yt-dlp запущен: {YTDLP_WORKERS} процессов")
+
+def shutdown_pool():
+    global _slots
+    _slots = None
+    for worker in _idle + list(_busy):
+        worker.kill()
+    _idle.clear()
+    _busy.clear()
+
+async def _call(worker: _Worker, func, args, timeout: float):
+    worker.conn.send((func, args))
+    return await asyncio.wait_for(asyncio.to_thread(worker.conn.recv), timeout)
+
+async def run(func, *args, timeout: float = YTDLP_INFO_TIMEOUT):
+    start_pool()
+    _stats['tasks'] += 1
+    async with _slots:
+        for attempt in range(2):
+            worker = _idle.pop() if _idle else await asyncio.to_thread(_Worker)
+            _busy.add(worker)
+            try:
+                status, value = await _call(worker, func, args, timeout)
+            except asyncio.TimeoutError:
+                _stats['timeouts'] += 1
+                logger.error(f"yt-dlp не уложился в {timeout:g} с ({func.__name__}), процесс перезапускается")
+                _discard(worker)
+                raise
+            except (EOFError, OSError) as e:
+                # процесс погиб — повторяем один раз на новом
+                _discard(worker)
+                if attempt:
+                    raise RuntimeError(f"Процесс yt-dlp завершился: {e}") from e
+                continue
+            except BaseException:
+                # отмена вызывающего: процесс остался посреди задачи
+                _discard(worker)
+                raise
+            _busy.discard(worker)
+            _idle.append(worker)
+            if status == 'error':
+                raise RuntimeError(value)
+            return value
+
+def _discard(worker: _Worker):
+    _busy.discard(worker)
+    _stats['restarts'] += 1
+    worker.kill()
+
+def get_stats() -> Dict:
+    return {**_stats, 'workers': YTDLP_WORKERS, 'running': _slots is not None, 'idle': len(_idle), 'busy': len(_busy)}